@@ -7,13 +7,13 @@ import torch
 from absl import flags
 from googleapiclient.discovery import build
 import tensorflow as tf
-import tensorflow_hub as hub
 from transformers import AutoModelWithLMHead, BertForSequenceClassification, BertConfig, AutoTokenizer, AutoConfig
 from t5.data import preprocessors
 
 #import caet5.data
-from caet5.data.dataset import at_preprocessor, tsv_to_dataset_fn, raw_to_tsv
-from caet5.evaluation.metrics import bleu, sentence_similarity, bert_attribute_accuracy_batch, gpt_perplexity_batch_280
+from caet5.data.dataset import at_preprocessor, tsv_to_dataset_fn, raw_to_tsv, raw_to_sharded_tsv, tsv_exists
+from caet5.evaluation.metrics import bleu, SentenceSimilarity, bert_attribute_accuracy_fast, \
+    gpt_perplexity_token_weighted
 from caet5.evaluation.metrics_utils import setup_parametric_evaluator, load_finetuned_transformer
 
 from caet5.data.utils import TaskRegistry_ll, MixtureRegistry_ll
@@ -33,10 +33,7 @@ if "BLEU" in FLAGS.metrics:
 
 ### Similarity
 if "SIM" in FLAGS.metrics:
-    module_url = FLAGS.use_module_url
-    pretrained_sentence_similarity_model = hub.Module(module_url)
-    metric_fns.append(functools.partial(sentence_similarity,
-                                        sentence_similarity_model=pretrained_sentence_similarity_model))
+    metric_fns.append(SentenceSimilarity(FLAGS.use_module_url))
 
 ## Attribute transfer and fluency
 if "ACC" in FLAGS.metrics or "PPL" in FLAGS.metrics:
@@ -44,7 +41,7 @@ if "ACC" in FLAGS.metrics or "PPL" in FLAGS.metrics:
 
     if "ACC" in FLAGS.metrics:
         setup_acc_parametric_metric = functools.partial(setup_parametric_evaluator,
-                                                        eval_fn=bert_attribute_accuracy_batch,
+                                                        eval_fn=bert_attribute_accuracy_fast,
                                                         evaluator_name="Fine-tuned attribute classifier",
                                                         metric_name="acc",
                                                         base_dir=FLAGS.base_dir,
@@ -52,7 +49,7 @@ if "ACC" in FLAGS.metrics or "PPL" in FLAGS.metrics:
                                                         gcs_service=gcs_service)
     if "PPL" in FLAGS.metrics:
         setup_ppl_parametric_metric = functools.partial(setup_parametric_evaluator,
-                                                        eval_fn=gpt_perplexity_batch_280,
+                                                        eval_fn=gpt_perplexity_token_weighted,
                                                         evaluator_name="Fine-tuned language model",
                                                         metric_name="ppl",
                                                         base_dir=FLAGS.base_dir,
@@ -109,12 +106,12 @@ dataset_tsv_path = {
             "test": os.path.join(data_dir, "%s-toxic-test.tsv" % task_name.lower())
         }
 
-tsvs_exist = [tf.io.gfile.exists(dataset_tsv_path[split]) for split in splits]
+tsvs_exist = [tsv_exists(dataset_tsv_path[split]) for split in splits]
 
-for i, tsv_exists in enumerate(tsvs_exist):
+for i, tsv_exist in enumerate(tsvs_exist):
     split = splits[i]
     split_raw = splits_raw[i]
-    if not tsv_exists:
+    if not tsv_exist:
         tf.compat.v1.logging.info("Generating TSV for the %s split." % split)
         mode = "r"
         ext = ["nontoxic", "toxic"]
@@ -123,7 +120,10 @@ for i, tsv_exists in enumerate(tsvs_exist):
         if split == "train":
             in_fnames.append((0, os.path.join(dataset_raw_dir, "%s.%s" % (split_raw, ext[0]))))
 
-        raw_to_tsv(in_fnames, dataset_tsv_path[split], mode=mode)
+        if FLAGS.tsv_num_shards > 0:
+            raw_to_sharded_tsv(in_fnames, dataset_tsv_path[split], FLAGS.tsv_num_shards, mode=mode)
+        else:
+            raw_to_tsv(in_fnames, dataset_tsv_path[split], mode=mode)
 
         tf.compat.v1.logging.info("TSV for the %s split generated." % split)
 
@@ -211,19 +211,22 @@ dataset_tsv_path = {
             "test": os.path.join(data_dir, "%s-test.tsv" % task_name.lower())
         }
 
-tsvs_exist = [tf.io.gfile.exists(dataset_tsv_path[split]) for split in splits]
+tsvs_exist = [tsv_exists(dataset_tsv_path[split]) for split in splits]
 
-for i, tsv_exists in enumerate(tsvs_exist):
+for i, tsv_exist in enumerate(tsvs_exist):
     split = splits[i]
     split_raw = splits_raw[i]
-    if not tsv_exists:
+    if not tsv_exist:
         tf.compat.v1.logging.info("Generating TSV for the %s split." % split)
         ext = ["neg", "pos"]
         dataset_raw_dir = os.path.join(FLAGS.base_dir, FLAGS.data_raw_dir_name)
         in_fnames = [(1, os.path.join(dataset_raw_dir, "%s.%s" % (split_raw, ext[1]))),
                      (0, os.path.join(dataset_raw_dir, "%s.%s" % (split_raw, ext[0])))]
 
-        raw_to_tsv(in_fnames, dataset_tsv_path[split])
+        if FLAGS.tsv_num_shards > 0:
+            raw_to_sharded_tsv(in_fnames, dataset_tsv_path[split], FLAGS.tsv_num_shards)
+        else:
+            raw_to_tsv(in_fnames, dataset_tsv_path[split])
 
         tf.compat.v1.logging.info("TSV for the %s split generated." % split)
 
@@ -303,19 +306,22 @@ dataset_tsv_path = {
             "test": os.path.join(data_dir, "%s-test.tsv" % task_name.lower())
         }
 
-tsvs_exist = [tf.io.gfile.exists(dataset_tsv_path[split]) for split in splits]
+tsvs_exist = [tsv_exists(dataset_tsv_path[split]) for split in splits]
 
-for i, tsv_exists in enumerate(tsvs_exist):
+for i, tsv_exist in enumerate(tsvs_exist):
     split = splits[i]
     split_raw = splits_raw[i]
-    if not tsv_exists:
+    if not tsv_exist:
         tf.compat.v1.logging.info("Generating TSV for the %s split." % split)
         ext = ["0", "1"]
         dataset_raw_dir = os.path.join(FLAGS.base_dir, FLAGS.data_raw_dir_name)
         in_fnames = [(1, os.path.join(dataset_raw_dir, "%s.%s" % (split_raw, ext[1]))),
                      (0, os.path.join(dataset_raw_dir, "%s.%s" % (split_raw, ext[0])))]
 
-        raw_to_tsv(in_fnames, dataset_tsv_path[split])
+        if FLAGS.tsv_num_shards > 0:
+            raw_to_sharded_tsv(in_fnames, dataset_tsv_path[split], FLAGS.tsv_num_shards)
+        else:
+            raw_to_tsv(in_fnames, dataset_tsv_path[split])
 
         tf.compat.v1.logging.info("TSV for the %s split generated." % split)
 
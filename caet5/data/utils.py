@@ -1,4 +1,6 @@
 import functools
+import json
+import os
 
 import gin
 from absl import logging
@@ -12,6 +14,11 @@ from t5.data.utils import _DEFAULT_FEATURE_KEYS, _VALID_TASK_NAME_REGEX, _INFO_F
 import tensorflow.compat.v1 as tf
 import tensorflow_datasets as tfds
 
+from caet5.data.dataset import encode_control_codes_ll
+
+# Features that may be added after tokenization rather than by text preprocessors.
+_TOKEN_LEVEL_FEATURES_ll = ("codeprefixedtargets", "controlcode")
+
 
 def balance_fn(x, balance_rate=0):
     if x["attribute"] <= 0.5: # tfds civil comments : "toxicity"
@@ -39,7 +46,8 @@ class Task_ll(t5.data.utils.Task):
             expected_output_type,
             expected_output_rank,
             error_label,
-            ensure_no_eos=False):
+            ensure_no_eos=False,
+            allow_missing=()):
         """Validates properties of a tf.data.Dataset, raising Exceptions if needed.
         Args:
           dataset: a tf.data.Dataset to validate.
@@ -49,12 +57,16 @@ class Task_ll(t5.data.utils.Task):
             report in raised ValueErrors.
           ensure_no_eos: a bool, whether or not to verify that the model features
             contain no EOS tokens.
+          allow_missing: a tuple of features that may be missing, because they are
+            added at a later processing step.
         Returns:TaskRegistry
           a validated tf.data.Dataset.
         """
         types = tf.compat.v1.data.get_output_types(dataset)
         shapes = tf.compat.v1.data.get_output_shapes(dataset)
         for feat in self.output_features:
+            if feat not in types and feat in allow_missing:
+                continue
             if feat not in types:
                 raise ValueError(
                     "Task dataset is missing expected output feature after {label}: "
@@ -94,7 +106,7 @@ class Task_ll(t5.data.utils.Task):
         dataset = self._preprocess_dataset(dataset, self._text_preprocessor)
         dataset = self._validate_dataset_ll(
             dataset, expected_output_type=tf.string, expected_output_rank=0,
-            error_label="text preprocessing")
+            error_label="text preprocessing", allow_missing=_TOKEN_LEVEL_FEATURES_ll)
         return dataset
 
     def preprocess_tokens_ll(self, dataset, sequence_length):
@@ -126,6 +138,78 @@ class Task_ll(t5.data.utils.Task):
             lambda ex: {k: _trim_and_append_eos(k, v) for k, v in ex.items()},
             num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
+    def _tokenized_dataset_ll(self, split, shuffle=True, balance=False):
+        """Returns the text preprocessed and tokenized split, before token preprocessing."""
+        ds = self._dataset_fn(split=split, shuffle_files=shuffle)
+        if balance:
+            ds = ds.filter(functools.partial(balance_fn, balance_rate=self.balance_rate))
+        ds = self.preprocess_text_ll(ds)
+        # Tokenize
+        ds = encode_string_features(
+            ds, self.get_vocabulary(), keys=self.output_features,
+            copy_plaintext=True)
+        return encode_control_codes_ll(ds, self.get_vocabulary())
+
+    def cache_dataset_ll(self, split, cache_dir, num_shards=1):
+        """Preprocesses and tokenizes a split once and writes it to cache_dir as TFRecords.
+        The text preprocessing (e.g. at_preprocessor) and SentencePiece tokenization of the `inputs`, `targets`,
+        `attribute`, `codeprefixedtargets` and `controlcode` features are run once. Token preprocessing (e.g.
+        denoising) is not cached, since it is random and should differ at each epoch. The TFRecords, info and stats
+        files follow the layout read by `get_dataset(use_cached=True)`, once cache_dir is added to the global cache
+        directories with `t5.data.add_global_cache_dirs`, and mark_cache_completed_ll is called after all the splits
+        are cached.
+        Args:
+          split: string, the split to cache.
+          cache_dir: string, the global cache directory. The split is written to cache_dir/[task_name].
+          num_shards: an integer, the number of TFRecord shards.
+        Returns:
+          a dict, the stats of the cached split.
+        """
+        task_cache_dir = os.path.join(cache_dir, self.name)
+        tf.io.gfile.makedirs(task_cache_dir)
+        # The cache is incomplete until mark_cache_completed_ll is called once all splits are cached.
+        completed_filename = os.path.join(task_cache_dir, "COMPLETED")
+        if tf.io.gfile.exists(completed_filename):
+            tf.io.gfile.remove(completed_filename)
+        tfrecord_prefix = os.path.join(task_cache_dir, _TFRECORD_PREFIX.format(split=split))
+
+        ds = self._tokenized_dataset_ll(split, shuffle=False)
+        features = {}
+        stats = {"examples": 0}
+        writers = [tf.io.TFRecordWriter("%s-%05d-of-%05d" % (tfrecord_prefix, shard_id, num_shards))
+                   for shard_id in range(num_shards)]
+        try:
+            for ex in tfds.as_numpy(ds):
+                feature = {}
+                for k, v in ex.items():
+                    if isinstance(v, bytes):
+                        features[k] = {"shape": [], "dtype": "string"}
+                        feature[k] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[v]))
+                    else:
+                        features[k] = {"shape": [None], "dtype": "int64"}
+                        feature[k] = tf.train.Feature(int64_list=tf.train.Int64List(value=v.tolist()))
+                        if k in self.output_features:
+                            stats["%s_tokens" % k] = stats.get("%s_tokens" % k, 0) + len(v)
+                            stats["%s_max_tokens" % k] = max(stats.get("%s_max_tokens" % k, 0), len(v))
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writers[stats["examples"] % num_shards].write(example.SerializeToString())
+                stats["examples"] += 1
+        finally:
+            for writer in writers:
+                writer.close()
+
+        with tf.io.gfile.GFile(os.path.join(task_cache_dir, _INFO_FILENAME.format(split=split)), "w") as f:
+            json.dump({"features": features, "num_shards": num_shards}, f)
+        with tf.io.gfile.GFile(os.path.join(task_cache_dir, _STATS_FILENAME.format(split=split)), "w") as f:
+            json.dump(stats, f)
+        logging.info("Cached %d examples of %s:%s in %s.", stats["examples"], self.name, split, task_cache_dir)
+        return stats
+
+    def mark_cache_completed_ll(self, cache_dir):
+        """Marks the cache of the task in cache_dir as completed, once all its splits are cached."""
+        with tf.io.gfile.GFile(os.path.join(cache_dir, self.name, "COMPLETED"), "w") as f:
+            f.write("")
+
     def get_dataset(
             self,
             sequence_length,
@@ -150,15 +234,13 @@ class Task_ll(t5.data.utils.Task):
         """
         if use_cached:
             ds = self._get_cached_dataset(split, shuffle)
+            # Attributes are cached as int64, but are int32 once processed on the fly.
+            ds = ds.map(
+                lambda ex: {k: tf.cast(v, tf.int32) if k == "attribute" else v for k, v in ex.items()},
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
         else:
-            ds = self._dataset_fn(split=split, shuffle_files=shuffle)
-            if self.balance_attributes and mode == "train":
-                ds = ds.filter(functools.partial(balance_fn, balance_rate=self.balance_rate))
-            ds = self.preprocess_text_ll(ds)
-            # Tokenize
-            ds = encode_string_features(
-                ds, self.get_vocabulary(), keys=self.output_features,
-                copy_plaintext=True)
+            ds = self._tokenized_dataset_ll(split, shuffle=shuffle,
+                                            balance=self.balance_attributes and mode == "train")
 
         if (not use_cached and self.num_input_examples(split) and
                 self.num_input_examples(split) < _MAX_EXAMPLES_TO_MEM_CACHE):
@@ -1,8 +1,18 @@
+import collections
+import contextlib
+import copy
+import functools
 import gin
+import hashlib
 import math
+import multiprocessing
+import os
+import tempfile
+import time
 import numpy as np
 import t5
 import tensorflow.compat.v1 as tf
+import tensorflow_hub as hub
 import torch
 from torch.utils.data import SequentialSampler, DataLoader
 from torch.nn.utils.rnn import pad_sequence
@@ -46,6 +56,114 @@ def gpt_perplexity_batch_280(targets, predictions, finetuned_model, tokenizer, d
 
   return {"perplexity": perplexity}
 
+def token_budget_batches(lengths, max_tokens_per_batch):
+  """Sorts sequences by decreasing length and groups them in batches of at most max_tokens_per_batch padded tokens.
+  Args:
+    lengths: a list of integers, the length of each sequence.
+    max_tokens_per_batch: an integer. Sequences longer than that make a batch of their own.
+  Returns:
+    a list of lists of indices of sequences.
+  """
+  batches = []
+  batch = []
+  for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+    # Batches are sorted by decreasing length, so their first sequence is the longest.
+    if batch and (len(batch) + 1) * lengths[batch[0]] > max_tokens_per_batch:
+      batches.append(batch)
+      batch = []
+    batch.append(i)
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+def inference_context(cpu_bfloat16=False):
+  """Returns a context manager for inference: torch.inference_mode (torch >= 1.9) or torch.no_grad, with bfloat16
+  autocast on CPU if cpu_bfloat16 and torch.autocast is available (torch >= 1.10)."""
+  stack = contextlib.ExitStack()
+  stack.enter_context(torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad())
+  if cpu_bfloat16:
+    if hasattr(torch, "autocast"):
+      stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+    else:
+      tf.logging.warning("torch %s has no torch.autocast, cpu_bfloat16 is ignored.", torch.__version__)
+  return stack
+
+
+_quantized_models = {}
+
+
+@gin.configurable
+def gpt_perplexity_token_weighted(targets, predictions, finetuned_model, tokenizer, device, max_tokens_per_batch=4096,
+                                  block_size=-1, cpu_bfloat16=False, cpu_quantize_int8=False, **unused_kwargs):
+  """Perplexity of the predictions under a language model, as gpt_perplexity_batch_280.
+  Predictions are sorted by length and batched up to max_tokens_per_batch padded tokens, and the negative
+  log-likelihood is summed over tokens, so that the perplexity is exp(total NLL / number of predicted tokens) rather
+  than the exponential of the mean of per-batch losses.
+  Args:
+    max_tokens_per_batch: an integer, the maximum number of padded tokens of a batch.
+    block_size: an integer, the maximum number of tokens of a prediction (-1 for the tokenizer's maximum).
+    cpu_bfloat16: a boolean, whether to run the model with bfloat16 autocast on CPU (torch >= 1.10, ignored
+      otherwise).
+    cpu_quantize_int8: a boolean, whether to run a dynamically int8-quantized copy of the model's nn.Linear layers on
+      CPU. The quantized copy of the model is cached across calls.
+  """
+  eval_dataset = MyDataset(tokenizer=tokenizer, prediction_list=predictions, block_size=block_size)
+  # Predictions of less than two tokens have no predicted token.
+  examples = [example for example in eval_dataset.examples if len(example) > 1]
+
+  model = finetuned_model
+  if cpu_quantize_int8:
+    if id(finetuned_model) not in _quantized_models:
+      # Quantize a CPU copy, the model is shared with other metric calls on its own device.
+      _quantized_models[id(finetuned_model)] = torch.quantization.quantize_dynamic(
+          copy.deepcopy(finetuned_model).cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+    model = _quantized_models[id(finetuned_model)]
+    device = torch.device("cpu")
+  model.eval()
+
+  total_nll = 0.0
+  total_tokens = 0
+  with inference_context(cpu_bfloat16):
+    for batch in token_budget_batches([len(example) for example in examples], max_tokens_per_batch):
+      input_ids = pad_sequence([torch.tensor(examples[i], dtype=torch.long) for i in batch], batch_first=True)
+      attention_mask = pad_sequence([torch.ones(len(examples[i]), dtype=torch.long) for i in batch],
+                                    batch_first=True)
+      input_ids = input_ids.to(device)
+      attention_mask = attention_mask.to(device)
+
+      logits = model(input_ids, attention_mask=attention_mask)[0]
+      # Each token is predicted from the previous ones, padding tokens are not predicted.
+      labels = input_ids[:, 1:].masked_fill(attention_mask[:, 1:] == 0, -100)
+      total_nll += torch.nn.functional.cross_entropy(
+          logits[:, :-1].float().reshape(-1, logits.size(-1)), labels.reshape(-1), ignore_index=-100,
+          reduction="sum").item()
+      total_tokens += attention_mask[:, 1:].sum().item()
+
+  if not total_tokens:
+    # No prediction has a predicted token.
+    return {"perplexity": float("nan")}
+  perplexity = math.exp(total_nll / total_tokens)
+
+  return {"perplexity": perplexity}
+
+
+def benchmark_gpt_perplexity(predictions, finetuned_model, tokenizer, device, **token_weighted_kwargs):
+  """Compares the predictions/sec and perplexities of gpt_perplexity_batch_280 and gpt_perplexity_token_weighted.
+  Returns:
+    a dict mapping each metric name to its predictions/sec and perplexity.
+  """
+  results = {}
+  for name, metric_fn in [("batch_280", gpt_perplexity_batch_280),
+                          ("token_weighted", functools.partial(gpt_perplexity_token_weighted,
+                                                               **token_weighted_kwargs))]:
+    start = time.time()
+    perplexity = float(metric_fn(None, predictions, finetuned_model, tokenizer, device)["perplexity"])
+    results[name] = {"predictions_per_sec": len(predictions) / (time.time() - start), "perplexity": perplexity}
+    tf.logging.info("%s: %.1f predictions/sec, perplexity %.2f", name, results[name]["predictions_per_sec"],
+                    perplexity)
+  return results
+
 def gpt_perplexity_batch_290(targets, predictions, finetuned_model, tokenizer, batch_size=8, block_size=256,
                              **unused_kwargs):
   # Too early, wait for transformers v2.9.0, otherwise:
@@ -155,6 +273,110 @@ def bert_attribute_accuracy_batch(targets, predictions, finetuned_model, tokeniz
   return {"attribute_accuracy": epoch_acc / len(valid_iterator)}
 
 
+_exported_classifiers = {}
+
+
+def _export_classifier(finetuned_model, backend, pad_token_id, export_dir=None, num_threads=None):
+  """Returns a function from (input_ids, attention_mask) to logits running a TorchScript or ONNX Runtime export of
+  finetuned_model on CPU, cached across calls.
+  The export is traced from a CPU copy of finetuned_model, which is shared with other metric calls on its own device.
+  """
+  key = (id(finetuned_model), backend)
+  if key in _exported_classifiers:
+    return _exported_classifiers[key]
+
+  cpu_model = copy.deepcopy(finetuned_model).cpu()
+  cpu_model.eval()
+  # Tracing records the operations on these inputs, their batch and length dimensions stay dynamic.
+  example_input_ids = torch.full((2, 8), pad_token_id, dtype=torch.long)
+  example_attention_mask = torch.ones((2, 8), dtype=torch.long)
+  with torch.no_grad():
+    if backend == "torchscript":
+      traced_model = torch.jit.trace(cpu_model, (example_input_ids, example_attention_mask), strict=False)
+
+      def classifier_fn(input_ids, attention_mask):
+        return traced_model(input_ids, attention_mask)[0]
+    elif backend == "onnxruntime":
+      import onnxruntime  # pylint: disable=g-import-not-at-top
+      onnx_path = os.path.join(export_dir or tempfile.mkdtemp(), "attribute_classifier.onnx")
+      torch.onnx.export(cpu_model, (example_input_ids, example_attention_mask), onnx_path,
+                        input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                        dynamic_axes={"input_ids": {0: "batch", 1: "length"},
+                                      "attention_mask": {0: "batch", 1: "length"},
+                                      "logits": {0: "batch"}})
+      session_options = onnxruntime.SessionOptions()
+      if num_threads:
+        session_options.intra_op_num_threads = num_threads
+      session = onnxruntime.InferenceSession(onnx_path, session_options)
+
+      def classifier_fn(input_ids, attention_mask):
+        logits = session.run(["logits"], {"input_ids": input_ids.numpy(),
+                                          "attention_mask": attention_mask.numpy()})[0]
+        return torch.from_numpy(logits)
+    else:
+      raise ValueError("Unknown backend %s" % backend)
+
+  _exported_classifiers[key] = classifier_fn
+  return classifier_fn
+
+
+@gin.configurable
+def bert_attribute_accuracy_fast(targets, predictions, finetuned_model, tokenizer, device, attributes_origin=None,
+                                 max_tokens_per_batch=8192, max_input_length=220, num_threads=None, backend="torch",
+                                 export_dir=None, **unused_kwargs):
+  """Attribute accuracy of the predictions under a fine-tuned BERT classifier, as bert_attribute_accuracy_batch.
+  Predictions are tokenized with the tokenizer's batch encoding, sorted by length and batched up to
+  max_tokens_per_batch padded tokens. The accuracy is averaged over predictions rather than over batches.
+  Args:
+    max_tokens_per_batch: an integer, the maximum number of padded tokens of a batch.
+    max_input_length: an integer, the maximum number of tokens of a prediction, including [CLS] and [SEP].
+    num_threads: an optional integer, the number of CPU threads of torch (and ONNX Runtime) during the call. The
+      number of threads of torch is process-global: metrics run concurrently by run_metric_fns_ll use it too until
+      the call returns and restores it.
+    backend: "torch", or "torchscript" or "onnxruntime" to run a traced or ONNX export of the classifier on CPU. The
+      export is cached across calls.
+    export_dir: an optional string, directory of the ONNX export (a temporary directory by default).
+  Returns:
+    a dict with the attribute accuracy and the number of predictions classified per second.
+  """
+  start = time.time()
+  previous_num_threads = torch.get_num_threads()
+  if num_threads:
+    torch.set_num_threads(num_threads)
+  try:
+    if backend == "torch":
+      finetuned_model.eval()
+
+      def classifier_fn(input_ids, attention_mask):
+        return finetuned_model(input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+    else:
+      classifier_fn = _export_classifier(finetuned_model, backend, tokenizer.pad_token_id, export_dir=export_dir,
+                                         num_threads=num_threads)
+
+    examples = tokenizer.batch_encode_plus(predictions, add_special_tokens=True,
+                                           max_length=max_input_length)["input_ids"]
+    attributes_origin = np.array(attributes_origin, dtype=np.float32)
+
+    prediction_labels = np.zeros(len(examples), dtype=np.float32)
+    with inference_context():
+      for batch in token_budget_batches([len(example) for example in examples], max_tokens_per_batch):
+        input_ids = pad_sequence([torch.tensor(examples[i], dtype=torch.long) for i in batch], batch_first=True,
+                                 padding_value=tokenizer.pad_token_id)
+        attention_mask = pad_sequence([torch.ones(len(examples[i]), dtype=torch.long) for i in batch],
+                                      batch_first=True)
+        logits = classifier_fn(input_ids, attention_mask)
+        prediction_labels[batch] = torch.round(torch.sigmoid(logits.squeeze(1).float())).cpu().numpy()
+  finally:
+    torch.set_num_threads(previous_num_threads)
+
+  # As bert_attribute_accuracy_batch, a prediction is correct if its attribute differs from the origin attribute.
+  attribute_accuracy = np.mean(prediction_labels != attributes_origin)
+  examples_per_sec = len(predictions) / (time.time() - start)
+  tf.logging.info("BERT attribute accuracy: %d predictions, %.1f predictions/sec", len(predictions), examples_per_sec)
+
+  return {"attribute_accuracy": attribute_accuracy, "attribute_accuracy_examples_per_sec": examples_per_sec}
+
+
 def bert_attribute_accuracy(targets, predictions, classifier_model, tokenizer, device, attributes_origin=None,
                             batch_size=32):
   batch_encoding = tokenizer.batch_encode_plus(predictions, max_length=tokenizer.max_len, pad_to_max_length=True)
@@ -205,6 +427,75 @@ def fasttext_attribute_accuracy(targets, predictions, classifier_model, attribut
   return {"attribute_accuracy": attribute_accuracy}
 
 
+
+def _fasttext_predict_labels(classifier_model, sentences):
+  # fastText predicts one line per sentence, and labels are "__label__[attribute]".
+  labels, _ = classifier_model.predict([sentence.replace("\n", " ") for sentence in sentences])
+  return np.array([label[0][-1] for label in labels])
+
+
+_fasttext_worker_model = None
+
+
+def _fasttext_worker_init(model_path):
+  import fasttext  # pylint: disable=g-import-not-at-top
+  global _fasttext_worker_model
+  _fasttext_worker_model = fasttext.load_model(model_path)
+
+
+def _fasttext_worker_predict_labels(sentences):
+  return _fasttext_predict_labels(_fasttext_worker_model, sentences)
+
+
+@gin.configurable
+def fasttext_attribute_accuracy_batch(targets, predictions, classifier_model, attributes_origin=None, chunk_size=10000,
+                                      num_processes=1, model_path=None, **unused_kwargs):
+  """Same as fasttext_attribute_accuracy, predicting the labels of chunks of chunk_size predictions at once.
+  If num_processes > 1, chunks are predicted by a pool of spawned processes, each loading the classifier from
+  model_path.
+  """
+  assert len(predictions) == len(attributes_origin), "The sizes of predictions and attributes_origin don't match"
+  if not predictions:
+    return {}
+  chunks = [predictions[start:start + chunk_size] for start in range(0, len(predictions), chunk_size)]
+  if num_processes > 1:
+    if not model_path:
+      raise ValueError("model_path must be set to predict with num_processes > 1.")
+    # Spawn rather than fork: forking a process where TensorFlow and torch already started threads may deadlock.
+    with multiprocessing.get_context("spawn").Pool(num_processes, initializer=_fasttext_worker_init,
+                                                   initargs=(model_path,)) as pool:
+      prediction_labels = pool.map(_fasttext_worker_predict_labels, chunks)
+  else:
+    prediction_labels = [_fasttext_predict_labels(classifier_model, chunk) for chunk in chunks]
+  prediction_labels = np.concatenate(prediction_labels)
+
+  attribute_accuracy = np.mean(prediction_labels != np.array(attributes_origin, dtype=str))
+
+  return {"attribute_accuracy": attribute_accuracy}
+
+
+def benchmark_fasttext_attribute_accuracy(predictions, classifier_model, attributes_origin, sizes=(10000, 100000),
+                                          **batch_kwargs):
+  """Compares the predictions/sec of fasttext_attribute_accuracy and fasttext_attribute_accuracy_batch.
+  predictions and attributes_origin are repeated to reach each size.
+  Returns:
+    a dict mapping each size to the predictions/sec of the loop and of the batched metric.
+  """
+  results = {}
+  for size in sizes:
+    repeats = -(-size // len(predictions))
+    size_predictions = (list(predictions) * repeats)[:size]
+    size_attributes_origin = (list(attributes_origin) * repeats)[:size]
+    results[size] = {}
+    for name, metric_fn in [("loop", fasttext_attribute_accuracy),
+                            ("batch", functools.partial(fasttext_attribute_accuracy_batch, **batch_kwargs))]:
+      start = time.time()
+      metric_fn(None, size_predictions, classifier_model, attributes_origin=size_attributes_origin)
+      results[size][name] = size / (time.time() - start)
+    tf.logging.info("fastText accuracy on %d predictions: loop %.0f predictions/sec, batch %.0f predictions/sec",
+                    size, results[size]["loop"], results[size]["batch"])
+  return results
+
 def bleu(targets, predictions, attributes_origin=None):
   return t5.evaluation.metrics.bleu(targets, predictions)
 
@@ -221,3 +512,64 @@ def sentence_similarity(targets, predictions, sentence_similarity_model, **unuse
     sentence_similarity_avg = sentence_similarity_all.mean()
     session.close()
   return {"sentence_similarity": sentence_similarity_avg}
+
+
+@gin.configurable
+class SentenceSimilarity(object):
+  """Universal Sentence Encoder similarity between targets and predictions, as sentence_similarity.
+  The module is loaded, and its variables and tables initialized, once in a session reused across evals. Sentences are
+  embedded in batches of batch_size, and the embeddings of the targets of the max_cached_targets most recently
+  evaluated eval sets are cached, so that an eval only embeds its predictions.
+  """
+
+  def __init__(self, module_url, batch_size=256, max_cached_targets=4):
+    self._module_url = module_url
+    self._batch_size = batch_size
+    self._max_cached_targets = max_cached_targets
+    self._session = None
+    self._targets_embeddings = collections.OrderedDict()
+
+  def _build(self):
+    graph = tf.Graph()
+    with graph.as_default():
+      self._sentences = tf.placeholder(tf.string, shape=[None])
+      self._embeddings = hub.Module(self._module_url)(self._sentences)
+      init_op = tf.group([tf.global_variables_initializer(), tf.tables_initializer()])
+    graph.finalize()
+    self._session = tf.Session(graph=graph)
+    self._session.run(init_op)
+
+  def _batches(self, sentences):
+    for start in range(0, len(sentences), self._batch_size):
+      yield start, sentences[start:start + self._batch_size]
+
+  def embed(self, sentences):
+    """Returns the embeddings of a list of sentences, computed in batches of batch_size."""
+    if self._session is None:
+      self._build()
+    return np.concatenate([self._session.run(self._embeddings, {self._sentences: batch})
+                           for _, batch in self._batches(sentences)])
+
+  def __call__(self, targets, predictions, **unused_kwargs):
+    if not predictions:
+      return {}
+    targets_key = hashlib.sha1("\n".join(targets).encode("utf-8")).hexdigest()
+    if targets_key in self._targets_embeddings:
+      self._targets_embeddings.move_to_end(targets_key)
+    else:
+      self._targets_embeddings[targets_key] = self.embed(targets)
+      # Evicts the least recently used eval sets.
+      while len(self._targets_embeddings) > self._max_cached_targets:
+        self._targets_embeddings.popitem(last=False)
+    targets_embeddings = self._targets_embeddings[targets_key]
+
+    # Predictions are embedded batch by batch and never kept in memory.
+    sentence_similarity_all = np.concatenate([
+        np.einsum('ij,ij->i', targets_embeddings[start:start + len(batch)], self.embed(batch))
+        for start, batch in self._batches(predictions)])
+    return {"sentence_similarity": sentence_similarity_all.mean()}
+
+  def close(self):
+    if self._session is not None:
+      self._session.close()
+    self._session = None
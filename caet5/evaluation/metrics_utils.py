@@ -77,6 +77,9 @@ def setup_parametric_evaluator(eval_fn, *load_fn_args, evaluator_name="Parametri
   def metric_fn(targets, predictions, *args, **kwargs):
       return partial_metric_fn(targets, predictions, *args, **kwargs)
 
+  # Name the metric after eval_fn, e.g. in the metric wall time summaries of eval_model_ll.
+  metric_fn.__name__ = eval_fn.__name__
+
   return metric_fn
 
 
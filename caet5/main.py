@@ -8,12 +8,15 @@ from absl import app, flags, logging
 import gin
 import pkg_resources
 from mesh_tensorflow.transformer import transformer, utils
+import t5
 import tensorflow.compat.v1 as tf
 import tensorflow_datasets as tfds
 
-from caet5.data.utils import TaskRegistry_ll
+from caet5.data.utils import TaskRegistry_ll, get_mixture_or_task_ll
 from caet5.evaluation.eval_utils import print_random_predictions
 from caet5.models.mtf_model import MtfModel_ll
+from caet5.models.predictor import Predictor_ll
+from caet5.models.serving import serve_ll
 from mesh_tensorflow_caet5.transformer import make_bitransformer_ll
 from mesh_tensorflow_caet5.utils import tpu_estimator_model_fn_ll
 
@@ -59,7 +62,7 @@ flags.DEFINE_boolean("use_model_api", False,
                      "Use Model API instead of utils.run.")
 
 flags.DEFINE_enum("mode", None,
-                  ["finetune", "eval", "predict"],
+                  ["finetune", "eval", "predict", "cache", "serve", "export"],
                   "Mode with which to run the model.")
 
 # Tasks args
@@ -75,6 +78,20 @@ flags.DEFINE_string(
     "data_dir_name", None,
     "Name of the directory containing data.")
 
+flags.DEFINE_integer(
+    "tsv_num_shards", 0,
+    "Number of TSV shards to write per split when generating TSVs from raw files. Default to 0 writes a single TSV "
+    "per split.")
+
+# Cache mode args
+flags.DEFINE_string(
+    "cache_dir", None,
+    "Directory of the pre-tokenized TFRecord caches of the tasks, e.g. gs://my-bucket/cache. In 'cache' mode, the "
+    "splits of --mixture_or_task are written there. In other modes, cached datasets are read from there when "
+    "use_cached=True.")
+
+flags.DEFINE_integer("cache_num_shards", 16, "Number of TFRecord shards per cached split.")
+
 # Train mode args
 flags.DEFINE_integer("train_steps", 1000, "Number of training iterations.")
 
@@ -118,6 +135,15 @@ flags.DEFINE_string("output_file", "", "Path to output file to save decodes.")
 
 flags.DEFINE_integer("predict_batch_size", -1, "Batch size when predicting.")
 
+# Export mode args
+flags.DEFINE_string("export_dir", "", "Directory to export SavedModels to. Defaults to [model_dir]/export.")
+
+# Serve mode args
+flags.DEFINE_string("serve_host", "localhost", "Host to serve on.")
+flags.DEFINE_integer("serve_port", 8501, "Port to serve on.")
+flags.DEFINE_float("serve_max_wait_ms", 10.,
+                   "Maximum time (in ms) a request waits for other requests to be batched with.")
+
 
 FLAGS = flags.FLAGS
 
@@ -153,6 +179,19 @@ def main(_):
 
     utils.parse_gin_defaults_and_flags()
 
+    if FLAGS.cache_dir:
+        t5.data.add_global_cache_dirs([FLAGS.cache_dir])
+
+    if FLAGS.mode == "cache":
+        if not FLAGS.cache_dir:
+            raise ValueError("--cache_dir must be set in 'cache' mode.")
+        for task in t5.data.get_subtasks(get_mixture_or_task_ll(FLAGS.mixture_or_task)):
+            for split in task.splits:
+                with gin.config_scope('caet5'):
+                    task.cache_dataset_ll(split, FLAGS.cache_dir, num_shards=FLAGS.cache_num_shards)
+            task.mark_cache_completed_ll(FLAGS.cache_dir)
+        return
+
     # Load and print a few examples.
     st_task = TaskRegistry_ll.get("processed_cctk")
     sequence_length = {"inputs": 64, "targets": 64}
@@ -299,6 +338,26 @@ def main(_):
                 input_file=FLAGS.input_file,
                 output_file=FLAGS.output_file,
                 temperature=0)
+
+        elif FLAGS.mode == "export":
+            if FLAGS.predict_batch_size > 0:
+                model.batch_size = FLAGS.predict_batch_size
+            if FLAGS.checkpoint_mode == "all" or (FLAGS.checkpoint_mode == "specific" and len(checkpoint_steps) != 1):
+                raise ValueError("'export' mode works with 'latest' or 'specific' with a single checkpoint.")
+            model.export(
+                export_dir=FLAGS.export_dir or None,
+                checkpoint_step=-1 if FLAGS.checkpoint_mode == "latest" else checkpoint_steps[0],
+                temperature=0)
+
+        elif FLAGS.mode == "serve":
+            if FLAGS.predict_batch_size > 0:
+                model.batch_size = FLAGS.predict_batch_size
+            if FLAGS.checkpoint_mode == "all" or (FLAGS.checkpoint_mode == "specific" and len(checkpoint_steps) != 1):
+                raise ValueError("'serve' mode works with 'latest' or 'specific' with a single checkpoint.")
+            predictor = Predictor_ll(model)
+            predictor.load_checkpoint(-1 if FLAGS.checkpoint_mode == "latest" else checkpoint_steps[0])
+            serve_ll(predictor, model.batch_size, max_wait_secs=FLAGS.serve_max_wait_ms / 1000.,
+                     host=FLAGS.serve_host, port=FLAGS.serve_port)
         else:
             raise ValueError("--mode flag must be set when using Model API.")
 
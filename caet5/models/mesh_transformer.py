@@ -2,14 +2,14 @@ import functools
 import gin
 from absl import logging
 import t5
-import tensorflow as tf
 import tensorflow_datasets as tfds
 
-from caet5.data.dataset import process_attribute
+from caet5.data.dataset import process_attribute, benchmark_dataset_by_key
 import mesh_tensorflow.transformer.dataset as transformer_dataset
 from mesh_tensorflow.transformer import utils as mtf_utils
 
-from mesh_tensorflow_caet5.dataset import pack_or_pad_ll
+from mesh_tensorflow_caet5.dataset import pack_or_pad_ll, group_by_attribute_ll, pack_by_attribute_ll, \
+    padding_efficiency
 from caet5.data.utils import get_mixture_or_task_ll
 
 
@@ -24,7 +24,11 @@ def mesh_train_dataset_fn_ll(
         use_cached=False,
         group_by_attribute=False,
         attribute_embedding=False,
-        attribute_num=2):
+        attribute_num=None,
+        pack=False,
+        pack_window_size=1024,
+        cut_cross_attention=False,
+        cycle_consistency_loss=False):
     """Returns the tf.data.Dataset for training on a given mixture.
     This uses the format required for utils.run's `train_dataset_fn` argument in
     the Mesh TF transformer standalone.
@@ -37,57 +41,56 @@ def mesh_train_dataset_fn_ll(
       dataset_split: string, which split of the dataset to load. In most cases
         this should be "train".
       use_cached: bool, whether to load the cached version of this dataset.
+      group_by_attribute: bool, whether to group examples so that each batch of batch_size examples has a single
+        attribute.
+      attribute_embedding: bool, whether the model embeds attributes.
+      attribute_num: deprecated and ignored, batches are grouped for any number of attributes.
+      pack: bool, whether to pack examples of the same attribute together when group_by_attribute=True. Packed
+        examples are only supported by models that attend to the whole encoder output (cut_cross_attention=False)
+        and are trained without the cycle consistency loss, which decodes whole rows.
+      pack_window_size: int, the number of examples of the same attribute to pack together if pack=True.
+      cut_cross_attention: bool, whether the model decodes from z pooled from the encoder output instead of attending
+        to the whole encoder output, as make_bitransformer_ll.cut_cross_attention. Packing is not supported then.
+      cycle_consistency_loss: bool, whether the model is trained with the cycle consistency loss, as
+        tpu_estimator_model_fn_ll.cycle_consistency_loss. Packing is not supported then.
     Returns:
       A tf.data.Dataset of preprocessed, tokenized, and batched examples.
     """
     if not isinstance(vocabulary, t5.data.SentencePieceVocabulary):
         raise ValueError("vocabulary must be a SentencePieceVocabulary")
 
+    if attribute_num is not None:
+        logging.warning("mesh_train_dataset_fn_ll.attribute_num is deprecated and ignored, batches are grouped for "
+                        "any number of attributes.")
+
     mixture_or_task = get_mixture_or_task_ll(mixture_or_task_name)
 
     with gin.config_scope('caet5'):
         ds = mixture_or_task.get_dataset(
             sequence_length, split=dataset_split, use_cached=use_cached, shuffle=True)
 
-    if group_by_attribute:  # TODO: Currently, we alternate deterministically batches of same attribute but it would be even better to alternate randomly
-        def filter_attribute_1_fn(x):
-            return tf.equal(x["attribute"][0], 1)
-
-        def filter_attribute_2_fn(x):
-            return tf.equal(x["attribute"][0], 2)
-
-        ds_attribute_1 = ds.filter(filter_attribute_1_fn)
-        ds_attribute_2 = ds.filter(filter_attribute_2_fn)
-
-        ds2_attribute_1 = pack_or_pad_ll(
-            ds_attribute_1, sequence_length, pack=False,
-            feature_keys=tuple(mixture_or_task.output_features),
-            ensure_eos=True)  # (not straightforward) Adapt packing so that pack=True
-        ds2_attribute_2 = pack_or_pad_ll(
-            ds_attribute_2, sequence_length, pack=False,
-            feature_keys=tuple(mixture_or_task.output_features),
-            ensure_eos=True)  # (not straightforward) Adapt packing so that pack=True
-
-        if attribute_embedding:
-            ds3_attribute_1 = process_attribute(ds2_attribute_1, mode="eval")
-            ds3_attribute_2 = process_attribute(ds2_attribute_2, mode="eval")
+    if group_by_attribute and pack and cut_cross_attention:
+        # z would be pooled from the whole row, e.g. from the first position of its first segment, and shared by all
+        # the segments packed in the row.
+        raise ValueError("pack=True is not supported with cut_cross_attention=True.")
+    if group_by_attribute and pack and cycle_consistency_loss:
+        # The transfer outputs are decoded from whole rows, not per packed segment.
+        raise ValueError("pack=True is not supported with cycle_consistency_loss=True.")
+
+    if group_by_attribute:
+        if pack:
+            ds = pack_by_attribute_ll(
+                ds, sequence_length, feature_keys=tuple(mixture_or_task.output_features),
+                window_size=pack_window_size, ensure_eos=True)
         else:
-            ds3_attribute_1 = ds2_attribute_1
-            ds3_attribute_2 = ds2_attribute_2
+            ds = pack_or_pad_ll(
+                ds, sequence_length, pack=False,
+                feature_keys=tuple(mixture_or_task.output_features),
+                ensure_eos=True)
+        ds = group_by_attribute_ll(ds, batch_size * (ensemble_inputs or 1))
 
-        def f1():
-            return ds3_attribute_1
-
-        def f2():
-            return ds3_attribute_2
-
-        def interleave_map_fn(x):
-            return tf.cond(tf.equal(x, 0), f1, f2)
-
-        ds = tf.data.Dataset.range(attribute_num).interleave(
-            interleave_map_fn, cycle_length=attribute_num,
-            block_length=batch_size * (ensemble_inputs or 1),
-            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if attribute_embedding:
+            ds = process_attribute(ds, mode="train" if pack else "eval")
 
     else:
         ds = pack_or_pad_ll(
@@ -98,6 +101,35 @@ def mesh_train_dataset_fn_ll(
     return ds
 
 
+def benchmark_mesh_train_dataset_fn_ll(mixture_or_task_name, sequence_length, vocabulary, batch_size,
+                                      num_examples=10000, **kwargs):
+    """Reports the per-attribute examples/sec of the attribute-grouped training dataset of a mixture or task."""
+    ds = mesh_train_dataset_fn_ll(
+        mixture_or_task_name, sequence_length, vocabulary, batch_size, ensemble_inputs=None,
+        group_by_attribute=True, **kwargs)
+    return benchmark_dataset_by_key(
+        ds, lambda ex: int(ex["attribute"][0]), num_examples, name=mixture_or_task_name)
+
+
+def report_padding_efficiency_ll(mixture_or_task_names, sequence_length, vocabulary, batch_size,
+                                 num_examples=10000, **kwargs):
+    """Reports the fraction of real (non-padding) tokens of attribute-grouped training batches, without and with
+    packing, for each mixture or task, e.g. ["yelp", "authors", "processed_cctk"]."""
+    # Only the batches are measured, so the model options that do not support packing do not apply.
+    kwargs = dict(kwargs, cut_cross_attention=False, cycle_consistency_loss=False)
+    report = {}
+    for mixture_or_task_name in mixture_or_task_names:
+        report[mixture_or_task_name] = {}
+        for pack in [False, True]:
+            ds = mesh_train_dataset_fn_ll(
+                mixture_or_task_name, sequence_length, vocabulary, batch_size, ensemble_inputs=None,
+                group_by_attribute=True, pack=pack, **kwargs)
+            efficiency = padding_efficiency(ds, num_examples=num_examples)
+            logging.info("%s, pack=%s: real tokens / total tokens = %s", mixture_or_task_name, pack, efficiency)
+            report[mixture_or_task_name]["packed" if pack else "padded"] = efficiency
+    return report
+
+
 @gin.configurable()
 def mesh_eval_dataset_fn_ll(
         mixture_or_task_name,
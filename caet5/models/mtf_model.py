@@ -1,4 +1,5 @@
 import functools
+import os
 import gin
 import t5
 from t5.models.mtf_model import MtfModel
@@ -6,7 +7,7 @@ from t5.models.mtf_model import _get_latest_checkpoint_from_dir, _operative_conf
 from mesh_tensorflow.transformer import utils
 from mesh_tensorflow.transformer import utils as mtf_utils
 
-from mesh_tensorflow_caet5.utils import eval_model_ll, infer_model_ll, train_model_ll
+from mesh_tensorflow_caet5.utils import eval_model_ll, export_model_ll, infer_model_ll, train_model_ll
 from caet5.data.utils import get_mixture_or_task_ll
 from caet5.models.mesh_transformer import mesh_train_dataset_fn_ll, mesh_eval_dataset_fn_ll
 
@@ -104,10 +105,8 @@ class MtfModel_ll(MtfModel):
           sentencepiece_model_path: str, path to the SentencePiece model file to use
             for decoding. Must match the one used during training.
         """
-        # TODO(sharannarang) : It would be nice to have a function like
-        # load_checkpoint that loads the model once and then call decode_from_file
-        # multiple times without having to restore the checkpoint weights again.
-        # This would be particularly useful in colab demo.
+        # To restore the checkpoint weights once and then predict several times, see
+        # caet5.models.predictor.Predictor_ll.
 
         if checkpoint_steps == -1:
             checkpoint_steps = _get_latest_checkpoint_from_dir(self._model_dir)
@@ -122,3 +121,32 @@ class MtfModel_ll(MtfModel):
                        self._sequence_length, self.batch_size,
                        self._model_type, self._model_dir, checkpoint_steps,
                        input_file, output_file)
+
+    def export(self, export_dir=None, checkpoint_step=-1, beam_size=1, temperature=1.0,
+               sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH):
+        """Exports a SavedModel whose serving signature takes raw strings and destination attributes.
+        Args:
+          export_dir: str, a directory in which to export SavedModels. Defaults to `model_dir`/export.
+          checkpoint_step: int, checkpoint to export. If -1 (default), use the latest checkpoint from the model
+            directory.
+          beam_size: int, a number >= 1 specifying the number of beams to use for beam search.
+          temperature: float, a value between 0 and 1 (must be 0 if beam_size > 1)
+            0.0 means argmax, 1.0 means sample according to predicted distribution.
+          sentencepiece_model_path: str, path to the SentencePiece model file to use for decoding. Must match the one
+            used during training.
+        Returns:
+          a string, the path of the exported SavedModel.
+        """
+        if checkpoint_step == -1:
+            checkpoint_step = _get_latest_checkpoint_from_dir(self._model_dir)
+        with gin.unlock_config():
+            gin.parse_config_file(_operative_config_path(self._model_dir))
+            gin.bind_parameter("Bitransformer_ll.decode.beam_size", beam_size)
+            gin.bind_parameter("Bitransformer_ll.decode.temperature", temperature)
+
+        vocabulary = t5.data.SentencePieceVocabulary(sentencepiece_model_path)
+        export_dir = export_dir or os.path.join(self._model_dir, "export")
+        return export_model_ll(self.estimator(vocabulary, disable_tpu=True), export_dir, vocabulary, self._sequence_length,
+                               self.batch_size,
+                               checkpoint_path=os.path.join(self._model_dir, "model.ckpt-%d" % checkpoint_step))
+
@@ -0,0 +1,176 @@
+import os
+import queue
+import time
+
+import gin
+import t5
+import tensorflow.compat.v1 as tf
+from absl import logging
+from mesh_tensorflow.transformer.utils import encode_inputs
+from t5.models.mtf_model import _get_latest_checkpoint_from_dir, _operative_config_path
+
+from caet5.data.dataset import process_attribute
+
+
+@gin.configurable
+class Predictor_ll(object):
+    """Long-lived predictor, which restores a checkpoint once and then decodes texts on demand.
+    The predictor keeps a single estimator.predict loop running, fed with batches through a queue, so that the graph,
+    the session and the restored variables are reused across calls to predict.
+    As for predictions with the model API, the CAE-T5 model function must be used, i.e.
+    mesh_tensorflow.transformer.utils.tpu_estimator_model_fn = tpu_estimator_model_fn_ll.
+    """
+
+    def __init__(self, model, sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH, control_codes_decode=None,
+                 attribute_embedding=False, eos_id=1):
+        """
+        Args:
+          model: a caet5.models.mtf_model.MtfModel_ll.
+          sentencepiece_model_path: str, path to the SentencePiece model file used during training.
+          control_codes_decode: an optional list of strings, the control code of each destination attribute.
+          attribute_embedding: bool, whether the model embeds attributes.
+          eos_id: EOS id
+        """
+        self._model = model
+        self._vocabulary = t5.data.SentencePieceVocabulary(sentencepiece_model_path)
+        self._control_codes_decode = control_codes_decode
+        self._attribute_embedding = attribute_embedding
+        self._eos_id = eos_id
+        self._queue = None
+        self._predictions = None
+        self.checkpoint_path = None
+
+    def load_checkpoint(self, checkpoint_step=-1, beam_size=1, temperature=0.0):
+        """Restores a checkpoint of the model directory and starts the prediction loop.
+        estimator.predict is lazy, so a warm-up batch is decoded to build the graph and restore the checkpoint here
+        rather than at the first call to predict, and to raise an error here if the checkpoint cannot be restored.
+        Args:
+          checkpoint_step: int, the step of the checkpoint to restore, or -1 for the latest checkpoint.
+          beam_size: int, a number >= 1 specifying the number of beams to use for beam search.
+          temperature: float, a value between 0 and 1 (must be 0 if beam_size > 1).
+        """
+        self.close()
+        model_dir = self._model._model_dir
+        if checkpoint_step == -1:
+            checkpoint_step = _get_latest_checkpoint_from_dir(model_dir)
+        self.checkpoint_path = os.path.join(model_dir, "model.ckpt-%d" % checkpoint_step)
+
+        with gin.unlock_config():
+            gin.parse_config_file(_operative_config_path(model_dir))
+            gin.bind_parameter("Bitransformer_ll.decode.beam_size", beam_size)
+            gin.bind_parameter("Bitransformer_ll.decode.temperature", temperature)
+
+        sequence_length = self._model._sequence_length
+        self._queue = queue.Queue()
+
+        def generator():
+            while True:
+                example = self._queue.get()
+                if example is None:
+                    return
+                yield example
+
+        output_types = {"inputs": tf.int32}
+        output_shapes = {"inputs": [sequence_length["inputs"]]}
+        if self._attribute_embedding:
+            output_types["attribute"] = tf.string
+            output_shapes["attribute"] = []
+        if self._control_codes_decode:
+            output_types["controlcode"] = tf.int32
+            output_shapes["controlcode"] = [sequence_length["controlcode"]]
+
+        def input_fn(params):
+            del params
+            dataset = tf.data.Dataset.from_generator(generator, output_types, output_shapes)
+            if self._attribute_embedding:
+                dataset = process_attribute(dataset, mode="infer")
+            # No prefetching: the generator only yields the examples of the current predict call.
+            return dataset.batch(self._model.batch_size, drop_remainder=True)
+
+        estimator = self._model.estimator(self._vocabulary)
+        self._predictions = estimator.predict(input_fn, checkpoint_path=self.checkpoint_path)
+        try:
+            self.predict([""], 0)
+        except Exception:
+            self._queue = None
+            self._predictions = None
+            raise
+
+    def check_dst_attribute(self, dst_attribute):
+        """Raises a ValueError if dst_attribute is not a destination attribute of the model."""
+        try:
+            attribute = int(dst_attribute)
+        except (TypeError, ValueError):
+            raise ValueError("dst_attribute must be an integer, got %r" % (dst_attribute,))
+        if self._control_codes_decode and not 0 <= attribute < len(self._control_codes_decode):
+            raise ValueError("dst_attribute must be between 0 and %d, got %d"
+                             % (len(self._control_codes_decode) - 1, attribute))
+
+    def predict(self, texts, dst_attribute):
+        """Rewrites texts into the destination attribute.
+        Args:
+          texts: a list of strings.
+          dst_attribute: a string or an int, the destination attribute (as in "|dst_attribute:" of input files), or a
+            list of destination attributes, one per text.
+        Returns:
+          a list of strings, one rewrite per text.
+        """
+        if self._predictions is None:
+            raise ValueError("load_checkpoint must be called before predict.")
+        batch_size = self._model.batch_size
+        sequence_length = self._model._sequence_length
+        all_input_ids = encode_inputs(texts, self._vocabulary, self._model._model_type, batch_size,
+                                      sequence_length["inputs"], eos_id=self._eos_id)
+        if isinstance(dst_attribute, (list, tuple)):
+            dst_attributes = list(dst_attribute)
+        else:
+            dst_attributes = [dst_attribute] * len(texts)
+        # Padding examples get the first destination attribute.
+        dst_attributes += dst_attributes[:1] * (len(all_input_ids) - len(texts))
+        if self._control_codes_decode:
+            control_codes = [self._control_codes_decode[int(a)] for a in dst_attributes[:len(texts)]]
+            all_controlcode_ids = encode_inputs(control_codes, self._vocabulary, "lm", batch_size,
+                                                sequence_length["controlcode"], eos_id=self._eos_id)
+        for i, input_ids in enumerate(all_input_ids):
+            example = {"inputs": input_ids}
+            if self._attribute_embedding:
+                example["attribute"] = str(dst_attributes[i])
+            if self._control_codes_decode:
+                example["controlcode"] = all_controlcode_ids[i]
+            self._queue.put(example)
+
+        decodes = []
+        for _ in range(len(all_input_ids)):
+            output_ids = [int(x) for x in next(self._predictions)["outputs"]]
+            if self._eos_id in output_ids:
+                output_ids = output_ids[:output_ids.index(self._eos_id)]
+            decodes.append(self._vocabulary.decode(output_ids))
+        return decodes[:len(texts)]
+
+    def close(self):
+        """Ends the prediction loop, if any."""
+        if self._queue is not None:
+            self._queue.put(None)
+            for _ in self._predictions:
+                pass
+        self._queue = None
+        self._predictions = None
+
+
+def benchmark_predictor_ll(predictor, texts, dst_attribute, num_calls=5, checkpoint_step=-1):
+    """Compares the latency of load_checkpoint, which builds the graph and restores the checkpoint, with the latency
+    of the following calls to predict.
+    Returns:
+      a dict with the seconds of load_checkpoint, of the first predict call and of each following predict call.
+    """
+    start = time.time()
+    predictor.load_checkpoint(checkpoint_step)
+    load_time = time.time() - start
+    latencies = []
+    for _ in range(num_calls):
+        start = time.time()
+        predictor.predict(texts, dst_attribute)
+        latencies.append(time.time() - start)
+    logging.info("load_checkpoint: %.2f sec, first predict: %.2f sec, next predicts: %s sec", load_time,
+                 latencies[0], ", ".join("%.2f" % latency for latency in latencies[1:]))
+    return {"load_checkpoint": load_time, "first_predict": latencies[0], "next_predicts": latencies[1:]}
@@ -0,0 +1,148 @@
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from absl import logging
+
+
+class _Request(object):
+    def __init__(self, text, dst_attribute):
+        self.text = text
+        self.dst_attribute = dst_attribute
+        self.start = time.time()
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher_ll(object):
+    """Coalesces concurrent rewriting requests into batches decoded by a Predictor_ll.
+    A batch is decoded as soon as it has max_batch_size requests, or max_wait_secs after its first request.
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait_secs=0.01, latency_window=10000):
+        self._predictor = predictor
+        self._max_batch_size = max_batch_size
+        self._max_wait_secs = max_wait_secs
+        self._requests = queue.Queue()
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._batch_sizes = collections.deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, text, dst_attribute):
+        """Blocks until the rewrite of text into dst_attribute is decoded, and returns it."""
+        request = _Request(text, dst_attribute)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.output
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        deadline = batch[0].start + self._max_wait_secs
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = self._predictor.predict([r.text for r in batch], [r.dst_attribute for r in batch])
+                for request, output in zip(batch, outputs):
+                    request.output = output
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception("Decoding a batch of %d requests failed.", len(batch))
+                for request in batch:
+                    request.error = e
+            end = time.time()
+            with self._lock:
+                self._batch_sizes.append(len(batch))
+                self._latencies.extend(end - request.start for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        """Returns the p50/p99 latencies (in ms) of the last requests, their mean batch size and the queue depth."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            batch_sizes = list(self._batch_sizes)
+
+        def percentile(p):
+            if not latencies:
+                return 0.
+            return 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+        return {
+            "p50_latency_ms": percentile(0.5),
+            "p99_latency_ms": percentile(0.99),
+            "mean_batch_size": sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0.,
+            "queue_depth": self._requests.qsize(),
+        }
+
+
+def serve_ll(predictor, max_batch_size, max_wait_secs=0.01, host="localhost", port=8501):
+    """Serves rewrites over HTTP.
+    POST /predict with a JSON body {"text": ..., "dst_attribute": ...} returns {"output": ...}.
+    GET /metrics returns the metrics of MicroBatcher_ll.
+    """
+    batcher = MicroBatcher_ll(predictor, max_batch_size, max_wait_secs)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send_json(200, batcher.metrics())
+            else:
+                self._send_json(404, {"error": "unknown path %s" % self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "unknown path %s" % self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                text, dst_attribute = request["text"], request["dst_attribute"]
+                if not isinstance(text, str):
+                    raise ValueError("text must be a string")
+                # An invalid destination attribute would fail the whole batch of the request.
+                predictor.check_dst_attribute(dst_attribute)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": "invalid request: %s" % e})
+                return
+            try:
+                output = batcher.predict(text, dst_attribute)
+            except Exception as e:  # pylint: disable=broad-except
+                self._send_json(500, {"error": "decoding failed: %s" % e})
+                return
+            self._send_json(200, {"output": output})
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logging.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info("Serving on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        predictor.close()
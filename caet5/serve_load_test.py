@@ -0,0 +1,65 @@
+r"""Load test of a CAE-T5 server started with `caet5 --mode=serve`.
+
+  python -m caet5.serve_load_test --port=8501 --num_requests=1000 --concurrency=32
+"""
+import json
+import threading
+import time
+import urllib.request
+
+from absl import app
+from absl import flags
+from absl import logging
+
+flags.DEFINE_string("host", "localhost", "Host of the server.")
+flags.DEFINE_integer("port", 8501, "Port of the server.")
+flags.DEFINE_integer("num_requests", 1000, "Total number of requests.")
+flags.DEFINE_integer("concurrency", 32, "Number of concurrent clients.")
+flags.DEFINE_string("text", "you are a complete idiot .", "Text to rewrite.")
+flags.DEFINE_string("dst_attribute", "1", "Destination attribute.")
+
+FLAGS = flags.FLAGS
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main(_):
+    base_url = "http://%s:%d" % (FLAGS.host, FLAGS.port)
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(FLAGS.num_requests))
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.time()
+            _post(base_url + "/predict", {"text": FLAGS.text, "dst_attribute": FLAGS.dst_attribute})
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(FLAGS.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    logging.info("%d requests in %.1f sec: %.1f requests/sec, client p50 %.1f ms, p99 %.1f ms",
+                 len(latencies), elapsed, len(latencies) / elapsed,
+                 1000 * latencies[len(latencies) // 2], 1000 * latencies[min(int(0.99 * len(latencies)),
+                                                                             len(latencies) - 1)])
+    with urllib.request.urlopen(base_url + "/metrics") as response:
+        logging.info("Server metrics: %s", response.read().decode("utf-8"))
+
+
+if __name__ == "__main__":
+    app.run(main)
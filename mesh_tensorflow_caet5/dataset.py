@@ -1,7 +1,10 @@
 import gin
 import tensorflow as tf
+import tensorflow_datasets as tfds
 from mesh_tensorflow.transformer.dataset import pack_dataset, trim_and_pad_dataset
 
+from caet5.data.dataset import ControlCodeRegistry
+
 
 def ensure_dataset_eos_ll(dataset, feature_keys=None):
   """Replaces the final token of features with EOS=1 if it is not PAD=0.
@@ -31,14 +34,12 @@ def shift_decoder_output_fn(dataset, left_pad_amts=None, feature_keys=None):
       return t
     return tf.pad(t, [(left_pad_amt, 0)] + [(0, 0)] * (len(t.shape) - 1))
 
-  def map_shift_decoder_output(x):
-    attribute = x["attribute"][0]
-    shifted = {k: _shift_decoder_output(k, t, 0) for k, t in x.items()}
-    for i in range(len(left_pad_amts)):
-        if tf.equal(attribute, i+1):
-            shifted = {k: _shift_decoder_output(k, t, left_pad_amts[i]) for k, t in x.items()}
+  # Attribute 0 is the padding attribute, whose decoder output is not shifted.
+  left_pad_amts_table = tf.constant([0] + list(left_pad_amts), dtype=tf.int32)
 
-    return shifted
+  def map_shift_decoder_output(x):
+    left_pad_amt = tf.gather(left_pad_amts_table, x["attribute"][0])
+    return {k: _shift_decoder_output(k, t, left_pad_amt) for k, t in x.items()}
 
   return dataset.map(
       lambda x: map_shift_decoder_output(x),
@@ -66,8 +67,8 @@ def pack_or_pad_ll(dataset, length, pack=True, feature_keys=None, ensure_eos=Fal
   """
   feature_keys = feature_keys or list(dataset.output_shapes.keys())
   if shift_decoder_output:
-    left_pad_amts = [len(tokenizer.encode(target_prefix_attribute)) - 1 for target_prefix_attribute in
-                     target_prefix_attributes]
+    left_pad_amts = [len(target_prefix_attribute_ids) - 1 for target_prefix_attribute_ids in
+                     ControlCodeRegistry.get(tokenizer, target_prefix_attributes)]
     dataset = shift_decoder_output_fn(dataset, left_pad_amts=left_pad_amts, feature_keys=feature_keys)
   if pack:
     dataset = pack_dataset(dataset, length=length, keys=feature_keys)
@@ -76,4 +77,61 @@ def pack_or_pad_ll(dataset, length, pack=True, feature_keys=None, ensure_eos=Fal
       dataset, length=length, feature_keys=feature_keys)
   if ensure_eos:
     dataset = ensure_dataset_eos_ll(dataset, feature_keys)
-  return dataset
\ No newline at end of file
+  return dataset
+
+
+def group_by_attribute_ll(dataset, batch_size):
+  """Groups examples into consecutive blocks of batch_size examples with the same attribute.
+  Examples are grouped in a single pass with tf.data.experimental.group_by_window, keyed on the attribute of each
+  example, so that this works for any number of attributes. A block is emitted as soon as batch_size examples of its
+  attribute have been read, so that attributes of consecutive blocks alternate randomly. Once batched by batch_size,
+  the dataset yields batches of a single attribute.
+  Args:
+    dataset: a tf.data.Dataset with an "attribute" feature, the attribute of each example being at index 0.
+    batch_size: an integer, the number of examples of each block.
+  Returns:
+    a tf.data.Dataset
+  """
+  def key_func(x):
+    return tf.cast(x["attribute"][0], tf.int64)
+
+  def reduce_func(unused_key, window):
+    return window.batch(batch_size, drop_remainder=True)
+
+  dataset = dataset.apply(tf.data.experimental.group_by_window(key_func, reduce_func, window_size=batch_size))
+  return dataset.unbatch()
+
+
+def pack_by_attribute_ll(dataset, length, feature_keys=None, window_size=1024, ensure_eos=False):
+  """Packs examples of the same attribute together.
+  Examples are grouped by attribute into windows of window_size examples, and the examples of each window are packed
+  with pack_or_pad_ll, so that each packed example has a single attribute. The "attribute" feature, if in
+  feature_keys, is packed like the other features, and may then be processed with process_attribute(mode="train").
+  Args:
+    dataset: a tf.data.Dataset with an "attribute" feature, the attribute of each example being at index 0.
+    length: an integer or a dict from feature-key to integer
+    feature_keys: (optional) list of strings, the feature names to pack.
+    window_size: an integer, the number of examples of the same attribute to pack together.
+    ensure_eos: a boolean, whether to replace the final token with EOS=1 if it is not PAD=0.
+  Returns:
+    a tf.data.Dataset where all features have fixed shape [length].
+  """
+  def key_func(x):
+    return tf.cast(x["attribute"][0], tf.int64)
+
+  def reduce_func(unused_key, window):
+    return pack_or_pad_ll(window, length, pack=True, feature_keys=feature_keys, ensure_eos=ensure_eos)
+
+  return dataset.apply(tf.data.experimental.group_by_window(key_func, reduce_func, window_size=window_size))
+
+
+def padding_efficiency(dataset, feature_keys=("inputs", "targets"), num_examples=10000):
+  """Returns the fraction of non-padding tokens of each feature over num_examples examples of a padded dataset."""
+  real_tokens = {k: 0 for k in feature_keys}
+  total_tokens = {k: 0 for k in feature_keys}
+  for ex in tfds.as_numpy(dataset.take(num_examples)):
+    for k in feature_keys:
+      real_tokens[k] += int((ex[k] != 0).sum())
+      total_tokens[k] += ex[k].size
+  return {k: real_tokens[k] / max(total_tokens[k], 1) for k in feature_keys}
+
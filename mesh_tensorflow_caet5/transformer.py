@@ -1,3 +1,5 @@
+import collections
+
 import gin
 import tensorflow.compat.v1 as tf
 import mesh_tensorflow as mtf
@@ -15,7 +17,8 @@ def make_bitransformer_ll(
     mesh_shape=None,
     encoder_name="encoder",
     decoder_name="decoder",
-    cut_cross_attention=False):
+    cut_cross_attention=False,
+    z_pooling="first"):
   """Gin-configurable bitransformer constructor.
   In your config file you need to set the encoder and decoder layers like this:
   encoder/make_layer_stack.layers = [
@@ -36,6 +39,10 @@ def make_bitransformer_ll(
       Some layers (e.g. MoE layers) cheat by looking at layout and mesh_shape
     encoder_name: optional - a string giving the Unitransformer encoder name.
     decoder_name: optional - a string giving the Unitransformer decoder name.
+    cut_cross_attention: a boolean, whether the decoder only sees a pooled encoder output z
+      instead of attending to the encoder outputs.
+    z_pooling: a string, how the encoder outputs are pooled into z if cut_cross_attention,
+      see Bitransformer_ll.
   Returns:
     a Bitransformer
   """
@@ -63,7 +70,7 @@ def make_bitransformer_ll(
         name=decoder_name,
         layout=layout,
         mesh_shape=mesh_shape)
-  return Bitransformer_ll(encoder, decoder, cut_cross_attention=cut_cross_attention)
+  return Bitransformer_ll(encoder, decoder, cut_cross_attention=cut_cross_attention, z_pooling=z_pooling)
 
 
 @gin.configurable
@@ -304,6 +311,9 @@ class Unitransformer_ll(Unitransformer):
                               never_end=False,
                               remove_partial_sequences=False,
                               sampling_keep_top_k=-1,
+                              sampling_keep_top_p=1.0,
+                              sampling_fused_top_k=False,
+                              sampling_num_candidates=64,
                               z=None):
         """Sample randomly one token at a time.
         The partial_sequences represent partial sequences to be continued.  The
@@ -334,6 +344,15 @@ class Unitransformer_ll(Unitransformer):
             sequences from the output
           sampling_keep_top_k: an integer - if not -1, only sample from the top k
             logits.
+          sampling_keep_top_p: a float - if lower than 1.0, only sample from the
+            smallest set of top logits whose probability (after temperature) sums
+            to at least sampling_keep_top_p (nucleus sampling), among the top
+            sampling_num_candidates (or sampling_keep_top_k) logits.
+          sampling_fused_top_k: a boolean - if True, sample from the top k logits
+            returned by a single top-k op rather than masking the logits below the
+            k-th largest over the whole vocabulary.
+          sampling_num_candidates: an integer, the number of top logits considered
+            by nucleus sampling when sampling_keep_top_k is -1.
         Returns:
           a Tensor with shape [<batch_dims>, length_dim]
         """
@@ -386,31 +405,26 @@ class Unitransformer_ll(Unitransformer):
         if not has_partial_sequences:
             initial_states = [
                 mtf.zeros_like(t) for t in context_first_part.new_states]
-            partial_sequences_eos_count = 0
         else:
             initial_states = context_first_part.new_states
-            partial_sequences_eos_count = mtf.reduce_sum(
-                mtf.to_int32(mtf.equal(partial_sequences, stop_at_token)),
-                reduced_dim=length_dim)
 
-        def cond_fn(position, ids, *unused_states):
-            """Should we run another loop iteration."""
+        def past_end_fn(position):
             past_end = mtf.greater_equal(position, length_dim.size)
             if max_steps:
                 past_end = mtf.logical_or(
                     past_end, mtf.greater_equal(position - initial_position, max_steps))
+            return past_end
 
-            is_done = past_end
-            if stop_at_token is not None:
-                eos_count = mtf.reduce_sum(
-                    mtf.to_int32(mtf.equal(ids, stop_at_token)),
-                    reduced_dim=length_dim)
-                has_additional_eos = mtf.greater(eos_count, partial_sequences_eos_count)
-                is_done = mtf.logical_or(is_done, has_additional_eos)
-            all_done = mtf.reduce_all(is_done)
-            return mtf.logical_not(all_done)
-
-        def body_fn(position, ids, *states):
+        # Running per-row mask of finished rows (1 if done), carried as loop state so that ids are not rescanned
+        # for stop_at_token at every step.
+        initial_done = mtf.to_int32(past_end_fn(initial_position))
+
+        def cond_fn(position, ids, done, *unused_states):
+            """Should we run another loop iteration."""
+            del position, ids
+            return mtf.logical_not(mtf.reduce_all(mtf.cast(done, tf.bool)))
+
+        def body_fn(position, ids, done, *states):
             """One step in the decode loop."""
             inputs_this_step = mtf.gather(ids, position - 1, length_dim)
             if self.attribute_embedding:
@@ -449,27 +463,40 @@ class Unitransformer_ll(Unitransformer):
                         dtype=logits.dtype)
 
             # TBD whether this should be before or after never_end:
-            # Note for adding top_p sampling in the future, in other code bases, the
-            # option to apply temperature is done before the top-k truncation. This
-            # implementation does this in the opposite order. For top-k this doesn't
-            # matter, but for top_p it will.
-            if sampling_keep_top_k != -1:
-                if sampling_keep_top_k <= 0:
-                    raise ValueError("sampling_keep_top_k must either be -1 or positive.")
-                k_largest = mtf.nth_largest_element(
-                    logits, n=sampling_keep_top_k,
-                    reduced_dim=self.output_vocab_dim)
-                logits = mtf.where(mtf.less_equal(logits, k_largest),
-                                   mtf.ones_like(logits) * -1e6, logits)
-
-            ids_this_step = mtf.sample_with_temperature(
-                logits, self.output_vocab_dim, temperature)
-            new_position = position + 1
+            # Temperature is applied after the top-k truncation, which does not
+            # matter for top-k, and before the top-p truncation, which does.
+            if sampling_keep_top_k != -1 and sampling_keep_top_k <= 0:
+                raise ValueError("sampling_keep_top_k must either be -1 or positive.")
+            if sampling_keep_top_p < 1.0 and temperature != 0:
+                num_candidates = (sampling_num_candidates if sampling_keep_top_k == -1
+                                  else sampling_keep_top_k)
+                ids_this_step = self._sample_from_top_candidates(
+                    logits, num_candidates, temperature, top_p=sampling_keep_top_p)
+            elif sampling_keep_top_k != -1 and sampling_fused_top_k:
+                ids_this_step = self._sample_from_top_candidates(
+                    logits, sampling_keep_top_k, temperature)
+            else:
+                if sampling_keep_top_k != -1:
+                    k_largest = mtf.nth_largest_element(
+                        logits, n=sampling_keep_top_k,
+                        reduced_dim=self.output_vocab_dim)
+                    logits = mtf.where(mtf.less_equal(logits, k_largest),
+                                       mtf.ones_like(logits) * -1e6, logits)
+
+                ids_this_step = mtf.sample_with_temperature(
+                    logits, self.output_vocab_dim, temperature)
+            # Finished rows are masked out: they neither write new ids nor advance.
+            not_done = 1 - done
+            ids_this_step *= not_done
+            new_position = position + not_done
             new_ids = ids + ids_this_step * mtf.one_hot(
                 position, length_dim, dtype=tf.int32)
-            return [new_position, new_ids] + context_incremental.new_states
+            new_done = mtf.logical_or(mtf.cast(done, tf.bool), past_end_fn(new_position))
+            if stop_at_token is not None:
+                new_done = mtf.logical_or(new_done, mtf.equal(ids_this_step, stop_at_token))
+            return [new_position, new_ids, mtf.to_int32(new_done)] + context_incremental.new_states
 
-        while_loop_inputs = [initial_position, inputs] + initial_states
+        while_loop_inputs = [initial_position, inputs, initial_done] + initial_states
         final_position, outputs = mtf.while_loop(
             cond_fn, body_fn, while_loop_inputs)[:2]
         del final_position
@@ -482,6 +509,32 @@ class Unitransformer_ll(Unitransformer):
                 outputs, -partial_length, length_dim, wrap=False)
         return outputs
 
+    def _sample_from_top_candidates(self, logits, num_candidates, temperature, top_p=1.0):
+        """Samples ids among the num_candidates top logits, with a single top-k op.
+        Args:
+          logits: a Tensor with shape [<batch_dims>, output_vocab_dim]
+          num_candidates: an integer, the number of top logits to sample from.
+          temperature: a floating point value between 0.0 and 1.0
+          top_p: a float - if lower than 1.0, only sample from the smallest set of
+            candidates whose probability sums to at least top_p.
+        Returns:
+          an int32 Tensor with shape [<batch_dims>]
+        """
+        candidates_dim = mtf.Dimension("candidates", num_candidates)
+        candidate_logits, candidate_ids = mtf.top_k(
+            logits, self.output_vocab_dim, candidates_dim)
+        if top_p < 1.0:
+            # Candidates are sorted by decreasing logits. Keep a candidate if the
+            # candidates before it sum to less than top_p.
+            probs = mtf.softmax(candidate_logits / temperature, candidates_dim)
+            exclusive_cumsum = mtf.cumsum(probs, candidates_dim, exclusive=True)
+            candidate_logits = mtf.where(
+                mtf.less(exclusive_cumsum, top_p), candidate_logits,
+                mtf.ones_like(candidate_logits) * -1e6)
+        sampled_candidates = mtf.sample_with_temperature(
+            candidate_logits, candidates_dim, temperature)
+        return mtf.gather(candidate_ids, sampled_candidates, candidates_dim)
+
     def beam_search(self,
                     inputs,
                     decode_length,
@@ -642,10 +695,47 @@ def shift_targets_no_offset(targets, bos_id=0, eos_id=1):
   return shifted_targets
 
 
+# Outputs of an encoder pass of Bitransformer_ll, which may be shared by call_simple and decode.
+EncoderOutputs_ll = collections.namedtuple(
+    "EncoderOutputs_ll", ["encoder_output", "z", "encoder_layer_outputs", "shared_params", "encoder_loss"])
+
+
 class Bitransformer_ll(Bitransformer):
-    def __init__(self, *bitransformer_args, cut_cross_attention=False, **bitransformer_kwargs):
+    def __init__(self, *bitransformer_args, cut_cross_attention=False, z_pooling="first", **bitransformer_kwargs):
+        """
+        Args:
+          cut_cross_attention: a boolean, whether the decoder only sees a pooled encoder output z instead of
+            attending to the encoder outputs.
+          z_pooling: a string, how the encoder outputs are pooled into z if cut_cross_attention: "first" (output at
+            the first position), "mean" (mean over non-padding positions) or "attention" (weighted by a learned
+            query over non-padding positions).
+        """
         super().__init__(*bitransformer_args, **bitransformer_kwargs)
+        if z_pooling not in ("first", "mean", "attention"):
+            raise ValueError("unknown z_pooling %s" % z_pooling)
         self.cut_cross_attention = cut_cross_attention
+        self.z_pooling = z_pooling
+
+    def _pool_encoder_output(self, encoder_output, inputs, variable_dtype):
+        """Pools the encoder outputs (with memory_length dimension) into z, see __init__."""
+        memory_length_dim = encoder_output.shape[-2]
+        model_dim = encoder_output.shape[-1]
+        if self.z_pooling == "first":
+            return mtf.gather(encoder_output,
+                              mtf.zeros(inputs.mesh, mtf.Shape(inputs.shape[:-1] + [model_dim]),
+                                        dtype=tf.int32), memory_length_dim)
+        mask = mtf.cast(mtf.not_equal(mtf.layers.rename_length_to_memory_length(inputs), 0),
+                        encoder_output.dtype)
+        if self.z_pooling == "mean":
+            return (mtf.reduce_sum(encoder_output * mask, reduced_dim=memory_length_dim)
+                    / mtf.maximum(mtf.reduce_sum(mask, reduced_dim=memory_length_dim), 1.))
+        with tf.variable_scope("z_pooling"):
+            query = mtf.get_variable(inputs.mesh, "query", mtf.Shape([model_dim]), dtype=variable_dtype)
+        scores = mtf.einsum([encoder_output, mtf.cast(query, encoder_output.dtype)],
+                            reduced_dims=[model_dim])
+        scores += (1. - mask) * -1e9
+        weights = mtf.softmax(scores, memory_length_dim)
+        return mtf.einsum([weights, encoder_output], reduced_dims=[memory_length_dim])
 
     def _shared_params(self, mesh, variable_dtype):
         """Create parameters that are shared between encoder and decoder.
@@ -685,6 +775,50 @@ class Bitransformer_ll(Bitransformer):
                         ensemble_dim=self.encoder.ensemble_dim)
         return shared_params
 
+    def encode(self,
+               inputs,
+               attributes=None,
+               compute_loss=False,
+               mode=tf.estimator.ModeKeys.TRAIN,
+               variable_dtype=mtf.VariableDType(tf.float32),
+               encoder_sequence_id=None,
+               encoder_position=None):
+        """Runs the encoder, so that its outputs may be shared by call_simple and decode.
+        Args:
+          inputs: an int32 Tensor with shape [<batch_dims>, length_dim]
+          attributes: an optional int32 Tensor with shape [<batch_dims>, length_dim]
+          compute_loss: a boolean
+          mode: a tf.estimator.ModeKeys
+          variable_dtype: a mtf.VariableDType
+          encoder_sequence_id: an optional Tensor
+          encoder_position: an optional Tensor
+        Returns:
+          an EncoderOutputs_ll, whose encoder_output (renamed to memory_length) and encoder_layer_outputs are None
+          and z is set if cut_cross_attention.
+        """
+        # With cut_cross_attention, the decoder only uses z, so the encoder layer outputs are not collected.
+        encoder_layer_outputs = None if self.cut_cross_attention else []
+        shared_params = self._shared_params(inputs.mesh, variable_dtype)
+        encoder_output, encoder_loss = self.encoder.call_simple(
+            inputs,
+            None,
+            compute_loss,
+            attributes=attributes,
+            mode=mode,
+            variable_dtype=variable_dtype,
+            sequence_id=encoder_sequence_id,
+            position=encoder_position,
+            shared_params=shared_params,
+            layer_outputs=encoder_layer_outputs)
+        encoder_output = mtf.layers.rename_length_to_memory_length(encoder_output)
+
+        if self.cut_cross_attention:
+            z = self._pool_encoder_output(encoder_output, inputs, variable_dtype)
+            encoder_output = None
+        else:
+            z = None
+        return EncoderOutputs_ll(encoder_output, z, encoder_layer_outputs, shared_params, encoder_loss)
+
     def call_simple(self,
                     inputs,
                     targets,
@@ -697,7 +831,8 @@ class Bitransformer_ll(Bitransformer):
                     decoder_sequence_id=None,
                     decoder_subsequence_id=None,
                     encoder_position=None,
-                    decoder_position=None):  # attributes=None for debugging?
+                    decoder_position=None,
+                    encoder_outputs=None):  # attributes=None for debugging?
         """Compute logits based on inputs (all positions in parallel).
         This is called during training and evaluation.
         Args:
@@ -712,36 +847,28 @@ class Bitransformer_ll(Bitransformer):
           decoder_subsequence_id: an optional Tensor
           encoder_position: an optional Tensor
           decoder_position: an optional Tensor
+          encoder_outputs: an optional EncoderOutputs_ll, the outputs of self.encode(inputs) if already computed.
         Returns:
           logits: a Tensor with shape [<batch_dims>, output_vocab_dim]
           loss: an optional Scalar (if compute_loss=True)
         """
-        encoder_layer_outputs = []
-        shared_params = self._shared_params(inputs.mesh, variable_dtype)
-        encoder_output, encoder_loss = self.encoder.call_simple(
-            inputs,
-            None,
-            compute_loss,
-            attributes=attributes,
-            mode=mode,
-            variable_dtype=variable_dtype,
-            sequence_id=encoder_sequence_id,
-            position=encoder_position,
-            shared_params=shared_params,
-            layer_outputs=encoder_layer_outputs)
-        encoder_output = mtf.layers.rename_length_to_memory_length(encoder_output)
-        if encoder_sequence_id is not None:
+        if encoder_outputs is None:
+            encoder_outputs = self.encode(
+                inputs,
+                attributes=attributes,
+                compute_loss=compute_loss,
+                mode=mode,
+                variable_dtype=variable_dtype,
+                encoder_sequence_id=encoder_sequence_id,
+                encoder_position=encoder_position)
+        encoder_output, z, encoder_layer_outputs, shared_params, encoder_loss = encoder_outputs
+        if self.cut_cross_attention:
+            # The decoder does not attend to the encoder outputs.
+            encoder_sequence_id = None
+        elif encoder_sequence_id is not None:
             encoder_sequence_id = mtf.layers.rename_length_to_memory_length(
                 encoder_sequence_id)
 
-        if self.cut_cross_attention:
-            z = mtf.gather(encoder_output,
-                           mtf.zeros(inputs.mesh, mtf.Shape(inputs.shape[:-1] + [encoder_output.shape[-1]]),
-                                     dtype=tf.int32), encoder_output.shape[-2])
-            encoder_output = None
-        else:
-            z = None
-
         if codeprefixedtargets:
             decoder_input = shift_targets_no_offset(
                 codeprefixedtargets)  # shift_attribute_targets(targets, attribute_id=codeprefixedtargets), # codeprefixedtargets # mtf.zeros_like(targets)
@@ -784,7 +911,11 @@ class Bitransformer_ll(Bitransformer):
                decode_length_constant=10,
                max_decode_length=None,
                has_partial_sequences=False,
-               remove_partial_sequences=False):
+               remove_partial_sequences=False,
+               sampling_keep_top_k=None,
+               sampling_keep_top_p=None,
+               sampling_fused_top_k=None,
+               encoder_outputs=None):
         """Sampling or beam search.
         TODO(noam): should we make the output length dimension different from the
         input length dimension?
@@ -801,26 +932,42 @@ class Bitransformer_ll(Bitransformer):
           decode_length_multiplier: a float
           decode_length_constant: a float
           max_decode_length: an optional integer
+          sampling_keep_top_k: an optional integer - if not -1, only sample from the
+            top k logits (beam_size=1 only).
+          sampling_keep_top_p: an optional float - if lower than 1.0, nucleus
+            sampling (beam_size=1 only).
+          sampling_fused_top_k: an optional boolean, whether to sample from the
+            top k logits with a single top-k op.
+          The sampling arguments are only forwarded to
+          Unitransformer_ll.sample_autoregressive if set, so that its own
+          defaults or gin bindings apply otherwise.
+          encoder_outputs: an optional EncoderOutputs_ll, the outputs of
+            self.encode(inputs) if already computed, e.g. by call_simple in the
+            same train step.
+          With cut_cross_attention, the encoder still runs over the whole
+          inputs to pool z, but the decoder is only given z: no encoder
+          output, sequence ids, inputs or layer outputs.
         Returns:
           a Tensor with shape [<batch_dims>, beam_dim, length_dim]
         """
-        encoder_layer_outputs = []
-        shared_params = self._shared_params(inputs.mesh, variable_dtype)
         encoder_sequence_id = mtf.minimum(inputs, 1)
-        encoder_output, encoder_loss = self.encoder.call_simple(
-            inputs=inputs,
-            targets=None,
-            compute_loss=False,
-            attributes=attributes,
-            mode=tf.estimator.ModeKeys.PREDICT,
-            variable_dtype=variable_dtype,
-            sequence_id=encoder_sequence_id,
-            shared_params=shared_params,
-            layer_outputs=encoder_layer_outputs)
-        del encoder_loss
-        encoder_output = mtf.layers.rename_length_to_memory_length(encoder_output)
-        encoder_sequence_id = mtf.layers.rename_length_to_memory_length(
-            encoder_sequence_id)
+        if encoder_outputs is None:
+            encoder_outputs = self.encode(
+                inputs,
+                attributes=attributes,
+                compute_loss=False,
+                mode=tf.estimator.ModeKeys.PREDICT,
+                variable_dtype=variable_dtype,
+                encoder_sequence_id=encoder_sequence_id)
+        encoder_output, z, encoder_layer_outputs, shared_params, _ = encoder_outputs
+        if self.cut_cross_attention:
+            # The decoder only sees z: there is no encoder sequence to attend over.
+            encoder_sequence_id = None
+            encoder_inputs = None
+        else:
+            encoder_sequence_id = mtf.layers.rename_length_to_memory_length(
+                encoder_sequence_id)
+            encoder_inputs = mtf.layers.rename_length_to_memory_length(inputs)
         batch_dims = inputs.shape[:-1]
         length_dim = inputs.shape[-1]
         if max_decode_length is None:
@@ -828,14 +975,6 @@ class Bitransformer_ll(Bitransformer):
         else:
             decode_length_dim = mtf.Dimension("length", max_decode_length)
 
-        if self.cut_cross_attention:
-            z = mtf.gather(encoder_output,
-                           mtf.zeros(inputs.mesh, mtf.Shape(inputs.shape[:-1] + [encoder_output.shape[-1]]),
-                                     dtype=tf.int32), encoder_output.shape[-2])
-            encoder_output = None
-        else:
-            z = None
-
         if beam_size == 1:
             ids_shape = mtf.Shape(batch_dims + [decode_length_dim])
         else:
@@ -848,6 +987,11 @@ class Bitransformer_ll(Bitransformer):
             partial_sequences = mtf.zeros(inputs.mesh, ids_shape, dtype=tf.int32)
 
         if beam_size == 1:
+            sampling_kwargs = {
+                k: v for k, v in [("sampling_keep_top_k", sampling_keep_top_k),
+                                  ("sampling_keep_top_p", sampling_keep_top_p),
+                                  ("sampling_fused_top_k", sampling_fused_top_k)]
+                if v is not None}
             return self.decoder.sample_autoregressive(
                 partial_sequences,
                 dst_attributes=attributes,
@@ -855,12 +999,13 @@ class Bitransformer_ll(Bitransformer):
                 variable_dtype=variable_dtype,
                 encoder_output=encoder_output,
                 encoder_sequence_id=encoder_sequence_id,
-                encoder_inputs=mtf.layers.rename_length_to_memory_length(inputs),
+                encoder_inputs=encoder_inputs,
                 shared_params=shared_params,
                 has_partial_sequences=has_partial_sequences,
                 remove_partial_sequences=remove_partial_sequences,
                 encoder_layer_outputs=encoder_layer_outputs,
-                z=z)
+                z=z,
+                **sampling_kwargs)
         else:
             if temperature != 0:
                 raise ValueError(
@@ -881,7 +1026,7 @@ class Bitransformer_ll(Bitransformer):
                 variable_dtype=variable_dtype,
                 encoder_output=encoder_output,
                 encoder_sequence_id=encoder_sequence_id,
-                encoder_inputs=inputs,
+                encoder_inputs=None if self.cut_cross_attention else inputs,
                 alpha=alpha,
                 shared_params=shared_params,
                 encoder_layer_outputs=encoder_layer_outputs,
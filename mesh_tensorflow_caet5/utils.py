@@ -1,9 +1,18 @@
 import os
 
+import bisect
+import collections
+import concurrent.futures
 import functools
 import gin
+import hashlib
+import json
 import re
 import six
+import sys
+import time
+
+import numpy as np
 
 import tensorflow.compat.v1 as tf
 # from mesh_tensorflow.transformer.utils import *
@@ -19,7 +28,7 @@ from mesh_tensorflow.transformer.utils import _dynamic_text2self, get_variable_d
     write_lines_to_file, get_checkpoint_iterator, \
     get_step_from_checkpoint_path, decode, get_inputs_from_file, encode_inputs, decode_from_file
 
-from caet5.data.dataset import process_attribute
+from caet5.data.dataset import process_attribute, ControlCodeRegistry, gather_control_code_ids
 from mesh_tensorflow_caet5.transformer import Bitransformer_ll
 
 _INPUT_FEATURES_ll = [
@@ -58,7 +67,8 @@ def tpu_estimator_model_fn_ll(model_type,
                               cycle_consistency_loss=False,
                               lambda_ae=1.0,
                               lambda_cycle=1.0,
-                              score_in_predict_mode=False):
+                              score_in_predict_mode=False,
+                              share_cycle_encoder_pass=False):
     """Create a TPUEstimator model function.
     Args:
       model_type: a string. One of "bitransformer", "lm", "aligned", or
@@ -97,6 +107,11 @@ def tpu_estimator_model_fn_ll(model_type,
         train an ensemble where each model gets different inputs.
         You also need to configure Unitransformer.ensemble  to the right size.
         If None, then all models are trained on the same inputs.
+      share_cycle_encoder_pass: a boolean, with cycle_consistency_loss, whether a single encoder pass over the inputs
+        is shared by the autoencoder loss and the decoding of the transfer outputs. This changes the loss of existing
+        configs: the padding of unpacked inputs is masked, as decode does, in both the autoencoder and the cycle
+        passes, and decoding uses the encoder outputs of the train mode of the step (with dropout). If False
+        (default), the autoencoder loss and decode each run their own encoder pass, decode in PREDICT mode.
     Returns:
       a function to be passed to TPUEstimator
     """
@@ -320,6 +335,22 @@ def tpu_estimator_model_fn_ll(model_type,
 
             if isinstance(transformer_model, Bitransformer_ll):
                 if cycle_consistency_loss:
+                    ae_position_kwargs = position_kwargs
+                    encoder_outputs = None
+                    if share_cycle_encoder_pass:
+                        # A single encoder pass over the inputs is shared by the autoencoder pass and the decoding of
+                        # the transfer outputs. Unpacked inputs have no segmentation: mask their padding as decode
+                        # does.
+                        if ae_position_kwargs["encoder_sequence_id"] is None:
+                            ae_position_kwargs = dict(position_kwargs, encoder_sequence_id=mtf.minimum(inputs, 1))
+                        encoder_outputs = transformer_model.encode(
+                            inputs,
+                            attributes=attributes,
+                            compute_loss=True,
+                            mode=mode,
+                            variable_dtype=get_variable_dtype(),
+                            encoder_sequence_id=ae_position_kwargs["encoder_sequence_id"],
+                            encoder_position=ae_position_kwargs["encoder_position"])
                     logits_ae, l_ae = transformer_model.call_simple(
                         inputs=inputs,
                         targets=mtf_features["targets"],
@@ -328,20 +359,34 @@ def tpu_estimator_model_fn_ll(model_type,
                         codeprefixedtargets=codeprefixedtargets,
                         mode=mode,
                         variable_dtype=get_variable_dtype(),
-                        **position_kwargs)
+                        encoder_outputs=encoder_outputs,
+                        **ae_position_kwargs)
+
+                    if "inputs_aeonly" in mtf_features:
+                        # Autoencoder-only steps timing the autoencoder part of the cycle steps, see train_model_ll.
+                        return logits_ae, lambda_ae * l_ae
 
                     if has_partial_sequences:
                         controlcodes = mtf_features["controlcode"]
                     else:
                         controlcodes = None
 
-                    with gin.config_scope('training'):
-                        mtf_samples = transformer_model.decode(
-                            inputs, attributes=attributes, controlcodes=controlcodes, has_partial_sequences=has_partial_sequences,
-                            remove_partial_sequences=remove_partial_sequences, variable_dtype=get_variable_dtype())
-                        # mtf_samples = mtf.anonymize(mtf_samples)
-                    outputs = mtf_samples
-
+                    if "inputs_cycle" in mtf_features:
+                        # Transfer outputs decoded outside of the train step, see train_model_ll.
+                        outputs = mtf_features["inputs_cycle"]
+                    else:
+                        with gin.config_scope('training'):
+                            mtf_samples = transformer_model.decode(
+                                inputs, attributes=attributes, controlcodes=controlcodes, has_partial_sequences=has_partial_sequences,
+                                remove_partial_sequences=remove_partial_sequences, variable_dtype=get_variable_dtype(),
+                                encoder_outputs=encoder_outputs)
+                            # mtf_samples = mtf.anonymize(mtf_samples)
+                        outputs = mtf_samples
+
+                    cycle_position_kwargs = position_kwargs
+                    if share_cycle_encoder_pass and position_kwargs["encoder_sequence_id"] is None:
+                        # Mask the padding of the transfer outputs as that of the inputs of the autoencoder pass.
+                        cycle_position_kwargs = dict(position_kwargs, encoder_sequence_id=mtf.minimum(outputs, 1))
                     logits_cycle, l_cycle = transformer_model.call_simple(
                         inputs=outputs,
                         targets=mtf_features["targets"],
@@ -350,7 +395,7 @@ def tpu_estimator_model_fn_ll(model_type,
                         codeprefixedtargets=codeprefixedtargets,
                         mode=mode,
                         variable_dtype=get_variable_dtype(),
-                        **position_kwargs)
+                        **cycle_position_kwargs)
 
                     loss_ae_cycle = lambda_ae * l_ae + lambda_cycle * l_cycle
                     return logits_cycle, loss_ae_cycle
@@ -563,10 +608,224 @@ def write_lines_to_file_ll(lines, filename):
       output_file.write("{}\n".format(l))
 
 
+def bucket_by_length_ll(lengths, bucket_boundaries):
+  """Sorts examples by length and splits them into length buckets.
+  Args:
+    lengths: a list of integers, the (token) length of each example.
+    bucket_boundaries: a sorted list of integers, the maximum length of each bucket but the last one, which contains
+      all longer examples.
+  Returns:
+    a list of len(bucket_boundaries) + 1 lists of example indices, sorted by length.
+  """
+  buckets = [[] for _ in range(len(bucket_boundaries) + 1)]
+  for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+    buckets[bisect.bisect_left(bucket_boundaries, lengths[i])].append(i)
+  return buckets
+
+
+def decode_ll(estimator, input_fn, vocabulary, checkpoint_path=None, max_decode_length=None):
+  """Same as mesh_tensorflow.transformer.utils.decode, optionally stopping decoding after max_decode_length steps.
+  max_decode_length is bound to Unitransformer_ll.sample_autoregressive.max_steps in a dedicated gin scope, so that
+  the loop of batches of short inputs ends early without changing the shapes of the graph.
+  """
+  if not max_decode_length:
+    return decode(estimator, input_fn, vocabulary, checkpoint_path=checkpoint_path)
+  scope = "max_decode_length_%d" % max_decode_length
+  with gin.unlock_config():
+    gin.bind_parameter("%s/Unitransformer_ll.sample_autoregressive.max_steps" % scope, max_decode_length)
+  with gin.config_scope(scope):
+    return decode(estimator, input_fn, vocabulary, checkpoint_path=checkpoint_path)
+
+
+def decode_by_length_buckets_ll(estimator, features, vocabulary, batch_size, checkpoint_path, bucket_boundaries,
+                                bucket_max_decode_lengths=None, dataset_map_fn=None):
+  """Decodes examples sorted and batched by input length, and returns the decodes in the original order.
+  Args:
+    estimator: a TPUEstimator, with use_tpu=False
+    features: a dict from feature-key to a numpy array whose first dimension indexes examples. The "inputs" feature
+      is used to compute the length of each example.
+    vocabulary: a mtf.transformer.vocabulary.Vocabulary
+    batch_size: an integer
+    checkpoint_path: an optional string
+    bucket_boundaries: a sorted list of integers, see `bucket_by_length_ll`.
+    bucket_max_decode_lengths: an optional list of len(bucket_boundaries) + 1 integers (or None), the maximum number
+      of decoding steps of each bucket.
+    dataset_map_fn: an optional function applied to the tf.data.Dataset of each bucket before batching.
+  Returns:
+    a list of strings, one decode per example.
+  """
+  lengths = np.sum(features["inputs"] != 0, axis=-1).tolist()
+  decodes = [None] * len(lengths)
+  for bucket_id, indices in enumerate(bucket_by_length_ll(lengths, bucket_boundaries)):
+    if not indices:
+      continue
+    bucket_features = {k: v[indices] for k, v in features.items()}
+
+    def input_fn(params, bucket_features=bucket_features):
+      del params
+      dataset = tf.data.Dataset.from_tensor_slices(bucket_features)
+      if dataset_map_fn:
+        dataset = dataset_map_fn(dataset)
+      dataset = dataset.batch(batch_size, drop_remainder=False)
+      # Pad the final batch.
+      dataset = transformer_dataset.trim_and_pad_dataset(dataset, length=batch_size)
+      dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+      return dataset
+
+    max_decode_length = bucket_max_decode_lengths[bucket_id] if bucket_max_decode_lengths else None
+    tf.logging.info("Decoding %d examples of length <= %s (max_decode_length=%s)",
+                    len(indices), bucket_boundaries[bucket_id] if bucket_id < len(bucket_boundaries) else "inf",
+                    max_decode_length)
+    bucket_decodes = decode_ll(estimator, input_fn, vocabulary, checkpoint_path, max_decode_length)
+    for i, d in zip(indices, bucket_decodes[:len(indices)]):
+      decodes[i] = d
+  return decodes
+
+
+def benchmark_decode_skew_ll(decode_fn, short_inputs, long_inputs, vocabulary, batch_size,
+                             long_fractions=(0.0, 0.125, 0.5, 1.0), num_batches=10):
+  """Reports the decode-step latency against the completion skew of the rows of a batch.
+  Each batch mixes short and long inputs, the fraction of long inputs of a batch controlling how long its slowest rows
+  keep decoding after the other rows are done.
+  Args:
+    decode_fn: a function from a list of batch_size input strings to a list of decoded strings.
+    short_inputs: a list of strings, inputs whose decodes end early.
+    long_inputs: a list of strings, inputs whose decodes end late.
+    vocabulary: a mtf.transformer.vocabulary.Vocabulary, used to count the decoding steps of each batch.
+    batch_size: an integer
+    long_fractions: a list of floats, the fractions of long inputs per batch to benchmark.
+    num_batches: an integer, the number of batches to decode for each fraction.
+  Returns:
+    a dict mapping each fraction of long inputs to the average decode-step latency in seconds.
+  """
+  latencies = {}
+  for long_fraction in long_fractions:
+    num_long = int(round(long_fraction * batch_size))
+    batch = [long_inputs[i % len(long_inputs)] for i in range(num_long)] + \
+            [short_inputs[i % len(short_inputs)] for i in range(batch_size - num_long)]
+    total_time = 0.
+    total_steps = 0
+    for _ in range(num_batches):
+      start = time.time()
+      decodes = decode_fn(batch)
+      total_time += time.time() - start
+      total_steps += max(len(vocabulary.encode(d)) + 1 for d in decodes)
+    latencies[long_fraction] = total_time / max(total_steps, 1)
+    tf.logging.info("long inputs fraction %.3f: %.2f ms per decode step", long_fraction,
+                    1000 * latencies[long_fraction])
+  return latencies
+
+
+def _metric_fn_name(metric_fn):
+    while isinstance(metric_fn, functools.partial):
+        metric_fn = metric_fn.func
+    return getattr(metric_fn, "__name__", type(metric_fn).__name__)
+
+
+def run_metric_fns_ll(metric_fns, targets, predictions, max_workers=None, timeout_secs=None,
+                      timed_out_futures=None, **metric_kwargs):
+    """Runs metric functions concurrently in a thread pool.
+    Metric functions mostly run model inference or release the GIL, so that an eval takes about the time of its slowest
+    metric function rather than the sum of their times.
+    A metric function whose previous call timed out and is still running is not called again, since metric functions
+    hold models or sessions which are not thread-safe. A metric function which raises an exception is logged and
+    reported as NaN, without stopping the other metric functions.
+    Args:
+      metric_fns: a list of functions with the call signature `metric_fn(targets, predictions, **metric_kwargs)`.
+      targets: a list of strings
+      predictions: a list of strings
+      max_workers: an optional integer, the number of threads. Defaults to len(metric_fns).
+      timeout_secs: an optional number of seconds, counted from the start of each metric function, after which its
+        result is not waited for. Its thread is not interrupted. Metric functions which could not start because all
+        threads are held by timed out metric functions are cancelled.
+      timed_out_futures: an optional dict from id of metric function to the future of its timed out call, shared by
+        the calls of an eval loop (e.g. over checkpoints) so that timed out metric functions still running are
+        skipped. Futures are added when their call times out and removed once done.
+      **metric_kwargs: passed to each metric function, e.g. attributes_origin.
+    Returns:
+      a list of (metric_fn name, dict of metric results or None if skipped or timed out, wall time in seconds) tuples,
+      in the order of metric_fns. The dict of a metric function which raised an exception maps its name to NaN.
+    """
+    if timed_out_futures is None:
+        timed_out_futures = {}
+    max_workers = max_workers or len(metric_fns)
+    starts = {}
+
+    def _run(i, metric_fn):
+        starts[i] = time.time()
+        metric_result = metric_fn(targets, predictions, **metric_kwargs)
+        return metric_result, time.time() - starts[i]
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    for i, metric_fn in enumerate(metric_fns):
+        previous_future = timed_out_futures.get(id(metric_fn))
+        if previous_future is not None and not previous_future.done():
+            tf.logging.warning("Skipping %s, its previous call is still running.", _metric_fn_name(metric_fn))
+            futures.append(None)
+            continue
+        timed_out_futures.pop(id(metric_fn), None)
+        futures.append(executor.submit(_run, i, metric_fn))
+
+    results = []
+    num_timed_out = 0
+    try:
+        for i, (metric_fn, future) in enumerate(zip(metric_fns, futures)):
+            metric_result, metric_time = None, 0.
+            while future is not None:
+                if i in starts and timeout_secs is not None:
+                    timeout = max(0., starts[i] + timeout_secs - time.time())
+                elif i in starts:
+                    timeout = None
+                else:
+                    # Not started yet: wait for it to start, unless all threads are held by timed out calls.
+                    if num_timed_out >= max_workers and future.cancel():
+                        tf.logging.warning("Cancelling %s, no thread is available.", _metric_fn_name(metric_fn))
+                        break
+                    timeout = 1.
+                try:
+                    metric_result, metric_time = future.result(timeout=timeout)
+                    break
+                except concurrent.futures.CancelledError:
+                    break
+                except concurrent.futures.TimeoutError:
+                    if i in starts and timeout_secs is not None and time.time() >= starts[i] + timeout_secs:
+                        tf.logging.warning("%s timed out after %.1f secs.", _metric_fn_name(metric_fn), timeout_secs)
+                        timed_out_futures[id(metric_fn)] = future
+                        num_timed_out += 1
+                        metric_time = time.time() - starts[i]
+                        break
+                except Exception:  # pylint: disable=broad-except
+                    tf.logging.error("%s failed.", _metric_fn_name(metric_fn), exc_info=True)
+                    metric_result = {_metric_fn_name(metric_fn): float("nan")}
+                    metric_time = time.time() - starts.get(i, time.time())
+                    break
+            results.append((_metric_fn_name(metric_fn), metric_result, metric_time))
+    finally:
+        for future in futures:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+    return results
+
+
+def _eval_targets_cache_filename_ll(cache_dir, task_name, dataset_split, sequence_length, vocabulary, attribute_bit,
+                                    control_code_bool):
+    """Returns the eval targets cache file of a task split, keyed by sequence lengths, vocabulary and the
+    attribute_bit and control_code_bool options of eval_model_ll (attributes_origin is empty without attribute_bit)."""
+    vocabulary_hash = hashlib.sha1(vocabulary.sp_model).hexdigest()[:16]
+    sequence_length_key = "_".join("{}{}".format(k, v) for k, v in sorted(sequence_length.items()))
+    options_key = "attr{:d}-cc{:d}".format(bool(attribute_bit), bool(control_code_bool))
+    return os.path.join(cache_dir, "{}-{}-{}-{}-{}.json".format(task_name, dataset_split, sequence_length_key,
+                                                                vocabulary_hash, options_key))
+
+
+@gin.configurable
 def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
                   dataset_split, model_dir, eval_dataset_fn, eval_summary_dir,
                   eval_checkpoint_step, attribute_bit=True, unsupervised_attribute_transfer_metrics=True,
-                  control_code_bool=False):
+                  control_code_bool=False, bucket_boundaries=None, bucket_max_decode_lengths=None,
+                  targets_cache_dir=None, metric_max_workers=None, metric_timeout_secs=None):
     """Eval a Mesh-TF model.
     Args:
       estimator: Estimator object, created with the appropriate model_fn.
@@ -601,6 +860,19 @@ def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
         whose global steps are closest to the global steps provided. If None and
         mode="eval", run eval continuously waiting for new checkpoints via
         `tf.train.checkpoints_iterator`.
+      bucket_boundaries: an optional sorted list of integers. If set, examples are sorted and batched by input length,
+        see `bucket_by_length_ll`, instead of being batched in dataset order.
+      bucket_max_decode_lengths: an optional list of len(bucket_boundaries) + 1 integers, the maximum number of
+        decoding steps of each length bucket.
+      targets_cache_dir: an optional string, directory where the postprocessed targets and origin attributes of each
+        eval dataset are cached, see `_eval_targets_cache_filename_ll`. Later evals read them instead of iterating
+        over the eval datasets. The cache is not invalidated if the data of a task changes.
+        The eval examples are not kept in memory, so predictions are postprocessed with example=None: the
+        postprocess_fn of the tasks (t5.data.postprocessors.lower_text) ignores the example.
+      metric_max_workers: an optional integer, the number of metric functions run concurrently, see
+        `run_metric_fns_ll`. Defaults to all of them.
+      metric_timeout_secs: an optional number of seconds after which the results of metric functions still running
+        are not reported.
     """
     if eval_dataset_fn is None:
         raise ValueError("Must provide eval_dataset_fn through gin for eval.")
@@ -632,7 +904,6 @@ def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
 
     # Pre-load in all of the targets once before entering continuous eval loop
     cached_targets = {}
-    cached_examples = {}
     if attribute_bit:
         cached_attributes_origin = {}
     # Need to create a separate graph for loading in plaintext targets
@@ -640,29 +911,39 @@ def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
     with tf.Graph().as_default():
         for eval_dataset in eval_datasets:
             if eval_dataset.metric_fns:
-                ds = eval_dataset.dataset_fn()
-                # Create list of postprocessed text targets
-                examples = [ex for ex in tfds.as_numpy(ds)]
-                targets = [
-                    eval_dataset.postprocess_fn(  # pylint:disable=g-complex-comprehension
-                        tf.compat.as_text(ex["targets_plaintext"]),
-                        example=ex, is_target=True)
-                    for ex in examples
-                ]
-
-                if attribute_bit:
-                    attributes_origin = [
-                        str(ex["attribute"][0] - 1)
-                        for ex in examples
-                    ]
-
                 targets_filename = os.path.join(
                     eval_summary_dir,
                     "{}_targets".format(eval_dataset.name),
                 )
-                write_lines_to_file(targets, targets_filename)
+                cache_filename = None
+                if targets_cache_dir:
+                    cache_filename = _eval_targets_cache_filename_ll(
+                        targets_cache_dir, eval_dataset.name, dataset_split, sequence_length, vocabulary,
+                        attribute_bit, control_code_bool)
+                if cache_filename and tf.io.gfile.exists(cache_filename):
+                    tf.logging.info("Loading eval targets from %s", cache_filename)
+                    with tf.io.gfile.GFile(cache_filename) as f:
+                        cache = json.load(f)
+                    targets = cache["targets"]
+                    attributes_origin = cache["attributes_origin"]
+                else:
+                    # Create list of postprocessed text targets, without keeping the examples in memory
+                    targets = []
+                    attributes_origin = []
+                    for ex in tfds.as_numpy(eval_dataset.dataset_fn()):
+                        targets.append(eval_dataset.postprocess_fn(
+                            tf.compat.as_text(ex["targets_plaintext"]), example=ex, is_target=True))
+                        if attribute_bit:
+                            attributes_origin.append(str(ex["attribute"][0] - 1))
+                    if cache_filename:
+                        tf.io.gfile.makedirs(targets_cache_dir)
+                        with tf.io.gfile.GFile(cache_filename + ".tmp", "w") as f:
+                            json.dump({"targets": targets, "attributes_origin": attributes_origin}, f)
+                        tf.io.gfile.rename(cache_filename + ".tmp", cache_filename, overwrite=True)
+
+                if not (cache_filename and tf.io.gfile.exists(targets_filename)):
+                    write_lines_to_file(targets, targets_filename)
                 cached_targets[eval_dataset.name] = targets
-                cached_examples[eval_dataset.name] = examples
                 if attribute_bit:
                     cached_attributes_origin[eval_dataset.name] = attributes_origin
 
@@ -699,20 +980,38 @@ def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
         combined_ds = combined_ds.prefetch(tf.data.experimental.AUTOTUNE)
         return combined_ds
 
+    if bucket_boundaries:
+        # Only the input features are kept in memory, to be sorted by length.
+        bucket_features = collections.defaultdict(list)
+        with tf.Graph().as_default():
+            for eval_dataset in eval_datasets:
+                for ex in tfds.as_numpy(eval_dataset.dataset_fn()):
+                    for k in _INPUT_FEATURES_ll:
+                        if k in ex:
+                            bucket_features[k].append(ex[k])
+        bucket_features = {k: np.stack(v) for k, v in bucket_features.items()}
+
+    # Timed out metric function calls still running, skipped at the next checkpoints until they are done.
+    timed_out_metric_futures = {}
     checkpoint_paths = get_checkpoint_iterator(eval_checkpoint_step, model_dir)
     for checkpoint_path in checkpoint_paths:
         tf.logging.info("Checkpoint path %s" % checkpoint_path)
         global_step = int(get_step_from_checkpoint_path(checkpoint_path))
         if global_step == 0:
             continue
-        decodes = decode(estimator, input_fn, vocabulary, checkpoint_path)
+        if bucket_boundaries:
+            decodes = decode_by_length_buckets_ll(
+                estimator, bucket_features, vocabulary, batch_size, checkpoint_path, bucket_boundaries,
+                bucket_max_decode_lengths=bucket_max_decode_lengths)
+        else:
+            decodes = decode(estimator, input_fn, vocabulary, checkpoint_path)
         for eval_dataset in eval_datasets:
             # Extract the portion of decodes corresponding to this dataset
-            examples = cached_examples[eval_dataset.name]
-            dataset_size = len(examples)
+            dataset_size = len(cached_targets[eval_dataset.name])
+            # The examples are not kept in memory: the postprocess_fn of the tasks (lower_text) ignores example.
             predictions = [
-                eval_dataset.postprocess_fn(tf.compat.as_text(d), example=ex)
-                for d, ex in zip(decodes[:dataset_size], examples)
+                eval_dataset.postprocess_fn(tf.compat.as_text(d), example=None)
+                for d in decodes[:dataset_size]
             ]
             # Remove the used decodes.
             del decodes[:dataset_size]
@@ -725,23 +1024,27 @@ def eval_model_ll(estimator, vocabulary, sequence_length, batch_size,
             )
             write_lines_to_file_ll(predictions, predictions_filename)
 
-            for metric_fn in eval_dataset.metric_fns:
+            targets = cached_targets[eval_dataset.name]
+            metric_kwargs = {}
+            if unsupervised_attribute_transfer_metrics and attribute_bit:
+                metric_kwargs["attributes_origin"] = cached_attributes_origin[eval_dataset.name]
+            metric_results = run_metric_fns_ll(eval_dataset.metric_fns, targets, predictions,
+                                               max_workers=metric_max_workers, timeout_secs=metric_timeout_secs,
+                                               timed_out_futures=timed_out_metric_futures, **metric_kwargs)
+            for metric_fn_name, metric_result, metric_time in metric_results:
                 summary = tf.Summary()
-                targets = cached_targets[eval_dataset.name]
-                if unsupervised_attribute_transfer_metrics and attribute_bit:
-                    attributes_origin = cached_attributes_origin[eval_dataset.name]
-                    metric_result = metric_fn(targets, predictions, attributes_origin=attributes_origin)
-                else:
-                    metric_result = metric_fn(targets, predictions)
-                for metric_name, metric_value in metric_result.items():
+                tag = "eval/{}/time_secs/{}".format(eval_dataset.name, metric_fn_name)
+                tf.logging.info("%s at step %d: %.1f", tag, global_step, metric_time)
+                summary.value.add(tag=tag, simple_value=metric_time)
+                for metric_name, metric_value in (metric_result or {}).items():
                     tag = "eval/{}/{}".format(eval_dataset.name, metric_name)
                     tf.logging.info("%s at step %d: %.3f", tag, global_step, metric_value)
                     summary.value.add(tag=tag, simple_value=metric_value)
-                    summary_writer.add_summary(summary, global_step)
+                summary_writer.add_summary(summary, global_step)
             summary_writer.flush()
 
         # Only padding should remain.
-        expected_pad = -sum(len(t) for t in cached_targets.values()) % batch_size
+        expected_pad = 0 if bucket_boundaries else -sum(len(t) for t in cached_targets.values()) % batch_size
         if len(decodes) != expected_pad:
             raise ValueError("{} padded decodes, {} expected.".format(
                 len(decodes), expected_pad))
@@ -758,10 +1061,12 @@ def decode_from_file_ll(estimator,
                         eos_id=1,
                         repeats=1,
                         control_codes_decode=None,
-                        attribute_embedding=False):
+                        attribute_embedding=False,
+                        bucket_boundaries=None,
+                        bucket_max_decode_lengths=None):
     """Decode from a text file and write to output_filename.
     Args:
-      estimator: a TPUEstimator
+      estimator: a TPUEstimator, with use_tpu=False
       vocabulary: a mtf.transformer.vocabulary.Vocabulary
       model_type: a string
       batch_size: an integer
@@ -772,6 +1077,25 @@ def decode_from_file_ll(estimator,
       output_filename: a string
       eos_id: EOS id
       repeats: an integer, the number of times to repeat each input.
+      bucket_boundaries: an optional sorted list of integers. If set, inputs are sorted and batched by length, see
+        `bucket_by_length_ll`, and decodes are written in the order of the input file.
+      bucket_max_decode_lengths: an optional list of len(bucket_boundaries) + 1 integers, the maximum number of
+        decoding steps of each length bucket.
+    """
+    features = _encode_inputs_from_file_ll(input_filename, vocabulary, model_type, batch_size, sequence_length,
+                                           eos_id=eos_id, control_codes_decode=control_codes_decode,
+                                           attribute_embedding=attribute_embedding)
+    _decode_features_to_file_ll(estimator, features, vocabulary, batch_size, checkpoint_path, output_filename,
+                                repeats=repeats, attribute_embedding=attribute_embedding,
+                                bucket_boundaries=bucket_boundaries,
+                                bucket_max_decode_lengths=bucket_max_decode_lengths)
+
+
+def _encode_inputs_from_file_ll(input_filename, vocabulary, model_type, batch_size, sequence_length, eos_id=1,
+                                control_codes_decode=None, attribute_embedding=False):
+    """Reads and encodes the inputs and destination attributes of a text file.
+    Returns:
+      a dict from feature-key to a numpy array with one row per input (without batch padding).
     """
     inputs_and_dst_attributes = get_inputs_from_file(input_filename)
 
@@ -780,54 +1104,103 @@ def decode_from_file_ll(estimator,
     inputs = []
     dst_attributes = []
     control_code_strings = []
-    #for l in inputs_split:
-    #    inputs.append(l[0])
-    #    dst_attributes.append(l[1])
-    #    if l[1] == "1":
-    #        control_code_strings.append(target_prefix_style_1)
-    #    elif l[1] == "2":
-    #        control_code_strings.append(target_prefix_style_2)
-    #    else:
-    #        control_code_strings.append("")
-
     for l in inputs_split:
         inputs.append(l[0])
         dst_attributes.append(l[1])
-        control_code_strings.append(control_codes_decode[int(l[1])])  # TODO: in the old example we shall remove 1...
+        if control_codes_decode:
+            control_code_strings.append(control_codes_decode[int(l[1])])
 
     all_input_ids = encode_inputs(inputs, vocabulary, model_type, batch_size,
                                   sequence_length["inputs"], eos_id=eos_id)
+    features = {"inputs": np.array(all_input_ids[:len(inputs)])}
+    if attribute_embedding:
+        features["attribute"] = np.array(dst_attributes)
     if control_codes_decode:
         all_controlcode_ids = encode_inputs(control_code_strings, vocabulary, "lm", batch_size,
-                                           sequence_length["controlcode"], eos_id=eos_id)
+                                            sequence_length["controlcode"], eos_id=eos_id)
+        features["controlcode"] = np.array(all_controlcode_ids[:len(inputs)])
+    return features
 
-    def input_fn(params):
-        del params
 
-        tensors = {"inputs": all_input_ids}
-        if attribute_embedding:
-            tensors["attribute"] = dst_attributes
-        if control_codes_decode:
-            tensors["controlcode"] = all_controlcode_ids
-
-        dataset = tf.data.Dataset.from_tensor_slices(tensors)
-        if attribute_embedding:
-            dataset = process_attribute(dataset, mode="infer")
-        dataset = dataset.flat_map(
-            lambda x: tf.data.Dataset.from_tensors(x).repeat(repeats))
-        dataset = dataset.batch(batch_size, drop_remainder=True)
-        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
-        return dataset
+def _decode_features_ll(estimator, features, vocabulary, batch_size, checkpoint_path, repeats=1,
+                        attribute_embedding=False, bucket_boundaries=None, bucket_max_decode_lengths=None):
+    """Decodes features returned by _encode_inputs_from_file_ll with a checkpoint.
+    Returns:
+      a list of len(features["inputs"]) * repeats strings.
+    """
+    dataset_size = len(features["inputs"]) * repeats
+    if bucket_boundaries:
+        features = {k: np.repeat(v, repeats, axis=0) for k, v in features.items()}
+        decodes = decode_by_length_buckets_ll(
+            estimator, features, vocabulary, batch_size, checkpoint_path, bucket_boundaries,
+            bucket_max_decode_lengths=bucket_max_decode_lengths,
+            dataset_map_fn=functools.partial(process_attribute, mode="infer") if attribute_embedding else None)
+    else:
+        def input_fn(params):
+            del params
+            dataset = tf.data.Dataset.from_tensor_slices(features)
+            if attribute_embedding:
+                dataset = process_attribute(dataset, mode="infer")
+            dataset = dataset.flat_map(
+                lambda x: tf.data.Dataset.from_tensors(x).repeat(repeats))
+            # Pad the last batch by repeating the first examples.
+            dataset = dataset.concatenate(dataset.take(1).repeat(-dataset_size % batch_size))
+            dataset = dataset.batch(batch_size, drop_remainder=True)
+            dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+            return dataset
+
+        decodes = decode(
+            estimator, input_fn, vocabulary, checkpoint_path=checkpoint_path
+        )
+    # Remove any padded examples
+    return decodes[:dataset_size]
+
 
+def _decode_features_to_file_ll(estimator, features, vocabulary, batch_size, checkpoint_path, output_filename,
+                                **decode_kwargs):
+    decodes = _decode_features_ll(estimator, features, vocabulary, batch_size, checkpoint_path, **decode_kwargs)
     checkpoint_step = get_step_from_checkpoint_path(checkpoint_path)
-    decodes = decode(
-        estimator, input_fn, vocabulary, checkpoint_path=checkpoint_path
-    )
-    # Remove any padded examples
-    dataset_size = len(inputs) * repeats
-    decodes = decodes[:dataset_size]
-    output_filename = "{}-{}".format(output_filename, checkpoint_step)
-    write_lines_to_file(decodes, output_filename)
+    write_lines_to_file(decodes, "{}-{}".format(output_filename, checkpoint_step))
+    return checkpoint_step, decodes
+
+
+@gin.configurable
+def decode_from_file_multi_checkpoint_ll(estimator,
+                                         vocabulary,
+                                         model_type,
+                                         batch_size,
+                                         sequence_length,
+                                         checkpoint_paths,
+                                         input_filename=gin.REQUIRED,
+                                         output_filename=gin.REQUIRED,
+                                         eos_id=1,
+                                         repeats=1,
+                                         control_codes_decode=None,
+                                         attribute_embedding=False,
+                                         bucket_boundaries=None,
+                                         bucket_max_decode_lengths=None):
+    """Decodes a text file with several checkpoints, reading and encoding the inputs only once.
+    As decode_from_file_ll, decodes of each checkpoint are written to [output_filename]-[checkpoint_step]. They are
+    also written side by side to [output_filename]-steps.tsv, with a header line of checkpoint steps and one
+    tab-separated column per checkpoint.
+    Args:
+      checkpoint_paths: an iterable of checkpoint paths, e.g. returned by get_checkpoint_iterator.
+      The other arguments are those of decode_from_file_ll.
+    """
+    features = _encode_inputs_from_file_ll(input_filename, vocabulary, model_type, batch_size, sequence_length,
+                                           eos_id=eos_id, control_codes_decode=control_codes_decode,
+                                           attribute_embedding=attribute_embedding)
+    checkpoint_steps = []
+    all_decodes = []
+    for checkpoint_path in checkpoint_paths:
+        checkpoint_step, decodes = _decode_features_to_file_ll(
+            estimator, features, vocabulary, batch_size, checkpoint_path, output_filename, repeats=repeats,
+            attribute_embedding=attribute_embedding, bucket_boundaries=bucket_boundaries,
+            bucket_max_decode_lengths=bucket_max_decode_lengths)
+        checkpoint_steps.append(str(checkpoint_step))
+        all_decodes.append([re.sub(r'[\n\t]', " ", d, flags=re.S) for d in decodes])
+        write_lines_to_file(["\t".join(checkpoint_steps)] + ["\t".join(row) for row in zip(*all_decodes)],
+                            "{}-steps.tsv".format(output_filename))
 
 
 @gin.configurable
@@ -843,7 +1216,9 @@ def infer_model_ll(estimator,
                    checkpoint_paths=None,
                    decode_from_file_fn=decode_from_file,
                    control_codes_decode=None,
-                   attribute_embedding=False):
+                   attribute_embedding=False,
+                   streaming=False,
+                   reuse_inputs=False):
   """Infer a Mesh-TF model.
   Args:
     estimator: Estimator object, created with the appropriate model_fn.
@@ -861,14 +1236,37 @@ def infer_model_ll(estimator,
     output_filename: a string, output file to save decodes
     checkpoint_paths: optional list of checkpoints to run inference for
     decode_from_file_fn: decoding function, defaults to decode_from_file
+    control_codes_decode: an optional list of strings, the control code of each destination attribute.
+    attribute_embedding: a boolean, whether the model embeds attributes.
+    streaming: a boolean, whether to decode with decode_from_file_streaming_ll, which reads input_filename lazily
+      (or stdin if input_filename is "-") and writes sharded, resumable outputs.
+    reuse_inputs: a boolean, whether to decode with decode_from_file_multi_checkpoint_ll, which encodes the inputs
+      once for all checkpoints and writes their decodes side by side.
   """
-  if control_codes_decode or attribute_embedding:
+  if streaming:
+      decode_from_file_fn = functools.partial(decode_from_file_streaming_ll, control_codes_decode=control_codes_decode,
+                                              attribute_embedding=attribute_embedding)
+  elif control_codes_decode or attribute_embedding:
       decode_from_file_fn = functools.partial(decode_from_file_ll, control_codes_decode=control_codes_decode,
                                               attribute_embedding=attribute_embedding)
 
   if checkpoint_paths is None:
     checkpoint_paths = get_checkpoint_iterator(eval_checkpoint_step, model_dir)
 
+  if reuse_inputs and not streaming:
+    decode_from_file_multi_checkpoint_ll(
+        estimator,
+        vocabulary=vocabulary,
+        model_type=model_type,
+        batch_size=batch_size,
+        sequence_length=sequence_length,
+        checkpoint_paths=checkpoint_paths,
+        input_filename=input_filename,
+        output_filename=output_filename,
+        control_codes_decode=control_codes_decode,
+        attribute_embedding=attribute_embedding)
+    return
+
   for checkpoint_path in checkpoint_paths:
     decode_from_file_fn(
         estimator,
@@ -881,9 +1279,241 @@ def infer_model_ll(estimator,
         output_filename=output_filename)
 
 
+def encode_predict_features_ll(inputs, dst_attributes, vocabulary, sequence_length, batch_size, eos_id=1,
+                               control_codes_decode=None, attribute_embedding=False):
+  """Builds the features of a batch of raw inputs and destination attributes inside the graph.
+  This does what decode_from_file_ll does in Python: the inputs are tokenized and EOS-terminated, the "attribute"
+  feature is built as by process_attribute(mode="infer"), and the "controlcode" feature from the precomputed
+  ControlCodeRegistry ids of control_codes_decode. The batch is padded to batch_size with rows of zeros.
+  Args:
+    inputs: a 1-D string Tensor of at most batch_size inputs.
+    dst_attributes: a 1-D string Tensor, the destination attribute of each input.
+    vocabulary: a SentencePieceVocabulary
+    sequence_length: a dict from feature-key to integer the sequence length
+    batch_size: an integer
+    eos_id: EOS id
+    control_codes_decode: an optional list of strings, the control code of each destination attribute.
+    attribute_embedding: a boolean, whether the model embeds attributes.
+  Returns:
+    a dict from feature-key to an int32 Tensor with shape [batch_size, sequence_length[key]]
+  """
+  num_inputs = tf.shape(inputs)[0]
+  num_padding = batch_size - num_inputs
+  dst_attribute_ids = tf.pad(tf.strings.to_number(dst_attributes, out_type=tf.int32), [[0, num_padding]])
+
+  def _pad(ids, length):
+    ids = ids[:length]
+    return tf.pad(ids, [[0, length - tf.shape(ids)[0]]])
+
+  def _encode_input(string):
+    ids = tf.concat([tf.cast(vocabulary.encode_tf(string), tf.int32), [eos_id]], axis=0)
+    return _pad(ids, sequence_length["inputs"])
+
+  features = {"inputs": tf.pad(tf.map_fn(_encode_input, inputs, dtype=tf.int32), [[0, num_padding], [0, 0]])}
+  if attribute_embedding:
+    features["attribute"] = tf.expand_dims(dst_attribute_ids, -1) * tf.cast(
+        tf.not_equal(features["inputs"], 0), tf.int32)
+  if control_codes_decode:
+    # The control codes are not EOS-terminated partial sequences, as encoded by encode_inputs for "lm" models.
+    control_code_ids, control_code_lengths = ControlCodeRegistry.get_tensors(vocabulary, control_codes_decode)
+
+    def _control_code(index):
+      ids = tf.cast(gather_control_code_ids(control_code_ids, control_code_lengths, index), tf.int32)
+      return _pad(ids, sequence_length["controlcode"])
+
+    features["controlcode"] = tf.map_fn(_control_code, dst_attribute_ids, dtype=tf.int32)
+  return {k: tf.reshape(v, [batch_size, sequence_length[k]]) for k, v in features.items()}
+
+
+@gin.configurable
+def export_model_ll(estimator, export_dir, vocabulary, sequence_length, batch_size, checkpoint_path=None, eos_id=1,
+                    control_codes_decode=None, attribute_embedding=False):
+  """Exports a SavedModel whose serving signature takes raw strings and destination attributes.
+  The features are built inside the graph by encode_predict_features_ll, so that no preprocessing is needed to serve
+  the model.
+  Args:
+    estimator: a TPUEstimator, with use_tpu=False
+    export_dir: a string, directory to export the SavedModel to.
+    vocabulary: a SentencePieceVocabulary
+    sequence_length: a dict from feature-key to integer the sequence length, e.g. {"inputs": 64, "controlcode": 64}
+    batch_size: an integer, the batch size of the model. Requests must have at most batch_size inputs, and are padded
+      to batch_size.
+    checkpoint_path: an optional string, defaults to the latest checkpoint.
+    eos_id: EOS id
+    control_codes_decode: an optional list of strings, the control code of each destination attribute.
+    attribute_embedding: a boolean, whether the model embeds attributes.
+  Returns:
+    a string, the path of the exported SavedModel.
+  """
+  def serving_input_fn():
+    inputs = tf.placeholder(dtype=tf.string, shape=[None], name="inputs")
+    dst_attributes = tf.placeholder(dtype=tf.string, shape=[None], name="dst_attribute")
+    features = encode_predict_features_ll(
+        inputs, dst_attributes, vocabulary, sequence_length, batch_size, eos_id=eos_id,
+        control_codes_decode=control_codes_decode, attribute_embedding=attribute_embedding)
+    return tf.estimator.export.ServingInputReceiver(
+        features=features, receiver_tensors={"inputs": inputs, "dst_attribute": dst_attributes})
+
+  return estimator.export_saved_model(export_dir, serving_input_fn, checkpoint_path=checkpoint_path)
+
+
+def _streaming_shard_filename(output_prefix, shard_id):
+  return "%s-%05d" % (output_prefix, shard_id)
+
+
+@gin.configurable
+def decode_from_file_streaming_ll(estimator,
+                                  vocabulary,
+                                  model_type,
+                                  batch_size,
+                                  sequence_length,
+                                  checkpoint_path=None,
+                                  input_filename=gin.REQUIRED,
+                                  output_filename=gin.REQUIRED,
+                                  eos_id=1,
+                                  lines_per_shard=100000,
+                                  control_codes_decode=None,
+                                  attribute_embedding=False):
+    """Decodes a text file, or stdin, without loading it in memory, and writes the decodes to sharded files.
+    Input lines ("[text]|dst_attribute:[attribute]") are read lazily and tokenized inside the tf.data pipeline. The
+    decodes are appended to [output_filename]-[checkpoint_step]-[shard_id] files of lines_per_shard lines, each file
+    being renamed from a .tmp file once complete. When run again, decoding resumes after the last complete shard.
+    Args:
+      estimator: a TPUEstimator, with use_tpu=False
+      vocabulary: a SentencePieceVocabulary
+      model_type: a string, unused: inputs are always EOS-terminated as for "bitransformer" models.
+      batch_size: an integer
+      sequence_length: a dict from feature-key to integer the sequence length
+      checkpoint_path: an optional string
+      input_filename: a string, or "-" to read stdin (not resumable).
+      output_filename: a string
+      eos_id: EOS id
+      lines_per_shard: an integer, the number of decodes per output file.
+      control_codes_decode: an optional list of strings, the control code of each destination attribute.
+      attribute_embedding: a boolean, whether the model embeds attributes.
+    """
+    del model_type
+    checkpoint_step = get_step_from_checkpoint_path(checkpoint_path)
+    output_prefix = "{}-{}".format(output_filename, checkpoint_step)
+    first_shard_id = 0
+    if input_filename != "-":
+        while tf.io.gfile.exists(_streaming_shard_filename(output_prefix, first_shard_id)):
+            first_shard_id += 1
+    if first_shard_id:
+        tf.logging.info("Resuming decoding of %s after %d complete shards.", input_filename, first_shard_id)
+
+    def input_fn(params):
+        del params
+        if input_filename == "-":
+            dataset = tf.data.Dataset.from_generator(
+                lambda: (line.rstrip("\n") for line in sys.stdin), tf.string, tf.TensorShape([]))
+        else:
+            dataset = tf.data.TextLineDataset(input_filename)
+        dataset = dataset.skip(first_shard_id * lines_per_shard)
+        dataset = dataset.batch(batch_size)
+
+        def _features(lines):
+            texts = tf.strings.strip(tf.strings.regex_replace(lines, r"\|dst_attribute:.*$", ""))
+            dst_attributes = tf.strings.strip(tf.strings.regex_replace(lines, r"^.*\|dst_attribute:", ""))
+            return encode_predict_features_ll(
+                texts, dst_attributes, vocabulary, sequence_length, batch_size, eos_id=eos_id,
+                control_codes_decode=control_codes_decode, attribute_embedding=attribute_embedding)
+
+        dataset = dataset.map(_features, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        return dataset
+
+    shard_id = first_shard_id
+    num_lines = 0
+    output_file = None
+    for prediction in estimator.predict(input_fn, checkpoint_path=checkpoint_path):
+        if not prediction["inputs"].any():
+            # Padding of the last batch.
+            continue
+        if output_file is None:
+            output_file = tf.io.gfile.GFile(_streaming_shard_filename(output_prefix, shard_id) + ".tmp", "w")
+        output_ids = [int(x) for x in prediction["outputs"]]
+        if eos_id in output_ids:
+            output_ids = output_ids[:output_ids.index(eos_id)]
+        output_file.write("{}\n".format(re.sub(r'\n', r"\\n", vocabulary.decode(output_ids), flags=re.S)))
+        num_lines += 1
+        if num_lines == lines_per_shard:
+            output_file.close()
+            tf.io.gfile.rename(_streaming_shard_filename(output_prefix, shard_id) + ".tmp",
+                               _streaming_shard_filename(output_prefix, shard_id), overwrite=True)
+            output_file = None
+            shard_id += 1
+            num_lines = 0
+    if output_file is not None:
+        output_file.close()
+        tf.io.gfile.rename(_streaming_shard_filename(output_prefix, shard_id) + ".tmp",
+                           _streaming_shard_filename(output_prefix, shard_id), overwrite=True)
+
+
+def cycle_replay_examples_ll(train_dataset_fn, sequence_length, vocabulary, dataset_split="train"):
+  """Returns an endless iterator over numpy training examples, to fill the cycle replay buffers of train_model_ll.
+  The training pipeline is built once, so that successive replay buffers hold successive examples of the shuffled
+  training data, rather than examples from the start of a new pipeline each time.
+  """
+  with tf.Graph().as_default():
+    dataset = train_dataset_fn(
+        sequence_length=sequence_length,
+        vocabulary=vocabulary,
+        dataset_split=dataset_split)
+    return iter(tfds.as_numpy(dataset.repeat()))
+
+
+class _RunTimerHook(tf.train.SessionRunHook):
+  """Sums the wall time of the session.run calls of an estimator.train or estimator.predict call, without building the
+  graph, creating the session and restoring the checkpoint."""
+
+  def __init__(self):
+    self.run_secs = 0.
+    self._start = None
+
+  def before_run(self, run_context):
+    self._start = time.time()
+
+  def after_run(self, run_context, run_values):
+    self.run_secs += time.time() - self._start
+
+
+def decode_cycle_replay_buffer_ll(estimator, train_examples, batch_size, num_examples, checkpoint_path=None,
+                                  hooks=None):
+  """Decodes the transfer outputs of the next num_examples training examples with the latest (or given) checkpoint.
+  Args:
+    estimator: Estimator object, created with the appropriate model_fn.
+    train_examples: an iterator over numpy training examples, see `cycle_replay_examples_ll`.
+    batch_size: an integer, the global batch size of the estimator, i.e. batch_size * (ensemble_inputs or 1) of
+      train_model_ll.
+    num_examples: an integer, a multiple of batch_size.
+    checkpoint_path: an optional string, defaults to the latest checkpoint.
+    hooks: an optional list of tf.train.SessionRunHook, passed to estimator.predict.
+  Returns:
+    a dict from feature-key to a numpy array of num_examples examples, with the decoded outputs as "inputs_cycle".
+  """
+  examples = [next(train_examples) for _ in range(num_examples)]
+  features = {k: np.stack([ex[k] for ex in examples]) for k in examples[0]}
+
+  def input_fn(params):
+    del params
+    dataset = tf.data.Dataset.from_tensor_slices(features)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
+
+  # Decode as in the train step, with the 'training' scope of the decoding gin parameters.
+  with gin.config_scope('training'):
+    predictions = estimator.predict(input_fn, checkpoint_path=checkpoint_path, hooks=hooks)
+    outputs = [p["outputs"] for p in predictions]
+  features["inputs_cycle"] = np.stack(outputs).astype(features["inputs"].dtype)
+  return features
+
+
+@gin.configurable
 def train_model_ll(estimator, vocabulary, sequence_length, batch_size,
                 train_dataset_fn, train_steps, ensemble_inputs,
-                dataset_split="train"):
+                dataset_split="train", cycle_replay_steps=None, cycle_timing_steps=None):
   """Train a Mesh-TF model.
   Args:
     estimator: Estimator object, created with the appropriate model_fn.
@@ -904,17 +1534,83 @@ def train_model_ll(estimator, vocabulary, sequence_length, batch_size,
       configure Unitransformer.ensemble  to the right size. If None, then all
       models are trained on the same inputs.
     dataset_split: str, which dataset split to train on.
+    cycle_replay_steps: an optional integer. If set, with the cycle consistency loss, the transfer outputs are not
+      decoded inside each train step: every cycle_replay_steps steps, the transfer outputs of the next examples of
+      the training data, one batch per cycle step of the next round, are decoded with the latest checkpoint into a
+      replay buffer, see `cycle_replay_examples_ll`. The cycle steps of the next round train on these examples only,
+      in shuffled whole batches. Until the first buffer is decoded, i.e. during the first round, the cycle pass
+      takes the inputs themselves as transfer outputs, so that it is an identity reconstruction.
+    cycle_timing_steps: an optional integer. If set with cycle_replay_steps, the first cycle_timing_steps steps of
+      each round train on the autoencoder loss only, to time the autoencoder part of a step. The sec/step of the
+      autoencoder part, of the cycle part of the train steps and of the replay buffer decoding are logged and
+      written as summaries to the model directory. Steps are timed over their session.run calls only, without the
+      graph building and checkpoint restoring of each estimator.train and estimator.predict call.
   """
 
-  def input_fn(params):
+  global_batch_size = batch_size * (ensemble_inputs or 1)
+
+  def input_fn(params, replay_buffer=None, ae_only=False):
     del params
+    if replay_buffer is not None:
+      # Batches of the replay buffer keep their attribute, so only whole batches are shuffled.
+      dataset = tf.data.Dataset.from_tensor_slices(replay_buffer)
+      dataset = dataset.batch(global_batch_size, drop_remainder=True)
+      dataset = dataset.shuffle(len(replay_buffer["inputs"]) // global_batch_size).repeat()
+      dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+      return dataset
     dataset = train_dataset_fn(
         sequence_length=sequence_length,
         vocabulary=vocabulary,
         dataset_split=dataset_split)
+    if ae_only:
+      dataset = dataset.map(lambda ex: dict(ex, inputs_aeonly=tf.zeros_like(ex["inputs"])))
+    elif cycle_replay_steps:
+      dataset = dataset.map(lambda ex: dict(ex, inputs_cycle=ex["inputs"]))
     dataset = dataset.batch(
-        batch_size * (ensemble_inputs or 1), drop_remainder=True).repeat() # swap batch and repeat to avoid modular problems that eventually causes batches of different attributes after some epochs
+        global_batch_size, drop_remainder=True).repeat() # swap batch and repeat to avoid modular problems that eventually causes batches of different attributes after some epochs
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
     return dataset
 
-  estimator.train(input_fn=input_fn, max_steps=train_steps)
+  if not cycle_replay_steps:
+    estimator.train(input_fn=input_fn, max_steps=train_steps)
+    return
+
+  latest_checkpoint = tf.train.latest_checkpoint(estimator.model_dir)
+  step = int(get_step_from_checkpoint_path(latest_checkpoint)) if latest_checkpoint else 0
+  train_examples = cycle_replay_examples_ll(train_dataset_fn, sequence_length, vocabulary, dataset_split=dataset_split)
+  summary_writer = tf.summary.FileWriter(estimator.model_dir)
+  replay_buffer = None
+  while step < train_steps:
+    next_step = min(step + cycle_replay_steps, train_steps)
+    ae_step = min(step + (cycle_timing_steps or 0), next_step)
+    ae_timer = _RunTimerHook()
+    if ae_step > step:
+      estimator.train(input_fn=functools.partial(input_fn, ae_only=True), max_steps=ae_step, hooks=[ae_timer])
+    train_timer = _RunTimerHook()
+    if next_step > ae_step:
+      estimator.train(input_fn=functools.partial(input_fn, replay_buffer=replay_buffer), max_steps=next_step,
+                      hooks=[train_timer])
+    decode_timer = _RunTimerHook()
+    if next_step < train_steps:
+      # Only the steps of the next round after its autoencoder-only steps train on the buffer.
+      next_cycle_steps = min(next_step + cycle_replay_steps, train_steps) - min(
+          next_step + (cycle_timing_steps or 0), train_steps)
+      replay_buffer = decode_cycle_replay_buffer_ll(
+          estimator, train_examples, global_batch_size, max(next_cycle_steps, 1) * global_batch_size,
+          hooks=[decode_timer])
+
+    secs_per_step = {"train_secs_per_step": train_timer.run_secs / max(next_step - ae_step, 1),
+                     "decode_secs_per_step": decode_timer.run_secs / (next_step - step)}
+    if ae_step > step:
+      secs_per_step["ae_secs_per_step"] = ae_timer.run_secs / (ae_step - step)
+      if next_step > ae_step:
+        secs_per_step["cycle_secs_per_step"] = (secs_per_step["train_secs_per_step"]
+                                                - secs_per_step["ae_secs_per_step"])
+    tf.logging.info("Steps %d to %d: %s", step, next_step,
+                    ", ".join("%s %.3f" % (k, v) for k, v in sorted(secs_per_step.items())))
+    summary = tf.Summary()
+    for k, v in sorted(secs_per_step.items()):
+      summary.value.add(tag="cycle_replay/%s" % k, simple_value=v)
+    summary_writer.add_summary(summary, next_step)
+    summary_writer.flush()
+    step = next_step